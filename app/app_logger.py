@@ -1,7 +1,110 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from env_settings import env
+
+# LogRecord attributes, anything else on a record came in through extra=
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+# message templates tracked by the rate limit, formatted messages would otherwise grow it forever
+RATE_LIMIT_MAX_KEYS = 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the fields passed in extra= next to the message"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the listener thread, with only the message rendered on the event loop"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per logger and message template for DEBUG records.
+
+    Hot path debug logs keep a trickle of samples instead of a line per
+    request, the next record let through tells how many were dropped.
+    INFO and above pass untouched, uvicorn's access lines all share one
+    template and would be cut to the rate of a single one.
+    """
+
+    def __init__(self, rate_per_s: float, burst: int):
+        super().__init__()
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.buckets = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate_per_s <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        if key not in self.buckets and len(self.buckets) >= RATE_LIMIT_MAX_KEYS:
+            self.buckets.clear()
+        tokens, updated, suppressed = self.buckets.get(key, (self.burst, now, 0))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate_per_s)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now, suppressed + 1)
+            return False
+        if suppressed:
+            record.suppressed = suppressed
+        self.buckets[key] = (tokens - 1, now, 0)
+        return True
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route every logger through a queue, written to stderr by a listener thread"""
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if env.LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(env.LOG_RATE_LIMIT_PER_S, env.LOG_RATE_LIMIT_BURST))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(env.LOG_LEVEL or ('DEBUG' if env.DEBUG else 'INFO'))
+    for name, level in env.LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level.upper())
+    # uvicorn installs its own stream handlers, send its error and access logs through the queue too
+    for name in ('uvicorn', 'uvicorn.error', 'uvicorn.access'):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+listener = setup_logging()
+logger = logging.getLogger('aluwa')
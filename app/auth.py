@@ -1,6 +1,7 @@
 from env_settings import env
 import logging
 import hashlib
+import time
 from typing import Annotated
 
 from fastapi import APIRouter, Query, status, HTTPException
@@ -9,7 +10,16 @@ from fastapi.responses import PlainTextResponse, RedirectResponse
 from joserfc import jwt
 from joserfc.errors import JoseError
 
+from cache import TTLCache
+
 BOT_TOKEN_HASH = hashlib.sha256(env.BOT_TOKEN.encode())
+# checks exp/nbf when a token carries them
+CLAIMS_REGISTRY = jwt.JWTClaimsRegistry()
+
+# sha256 of the raw token -> decoded token, or INVALID_TOKEN for rejected ones
+verified_token_cache = TTLCache(maxsize=env.TOKEN_CACHE_SIZE, ttl=env.TOKEN_CACHE_TTL_S)
+INVALID_TOKEN = object()
+token_cache_rejects = 0
 
 
 auth_router = APIRouter()
@@ -25,7 +35,6 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from queries.db_user_access import get_user_id_by_telegram_id
 
 logger = logging.getLogger('telegram.verification')
-logger.setLevel(logging.DEBUG)
 async def verify_init_data_is_correct(init_data: Dict[str, Any]) -> bool:
     """
     Verify Telegram WebApp initData authentication
@@ -36,7 +45,7 @@ async def verify_init_data_is_correct(init_data: Dict[str, Any]) -> bool:
     Returns:
         bool: True if verification succeeds, False otherwise
     """
-    logger.info("Starting Telegram WebApp initData verification")
+    logger.debug("Starting Telegram WebApp initData verification")
 
     try:
         # 1. Extract and validate hash
@@ -52,7 +61,6 @@ async def verify_init_data_is_correct(init_data: Dict[str, Any]) -> bool:
 
         # Sort parameters alphabetically
         data_check_string = "\n".join(sorted(data_check_items))
-        logger.debug(f"Data check string: {data_check_string}")
 
         # 3. Compute secret key
         secret_key = hmac.new(
@@ -68,46 +76,58 @@ async def verify_init_data_is_correct(init_data: Dict[str, Any]) -> bool:
             digestmod=hashlib.sha256
         ).hexdigest()
 
-        logger.debug(f"Computed hash: {computed_hash}")
-        logger.debug(f"Received hash: {received_hash}")
-
         # 5. Compare hashes
         if not hmac.compare_digest(computed_hash, received_hash):
-            logger.error("Hash verification failed")
-            logger.error(f"Expected: {computed_hash}")
-            logger.error(f"Received: {received_hash}")
+            logger.warning("Hash verification failed")
             return False
 
-        logger.info("Telegram WebApp verification successful")
+        logger.debug("Telegram WebApp verification successful")
         return True
 
     except Exception as e:
-        logger.error(f"Verification error: {str(e)}", exc_info=True)
+        logger.error("Verification error: %s", e, exc_info=True)
         return False
 
 def process_token(request: Request):
     token = request.cookies.get(env.COOKIE_NAME)
-    if token:
-        logger.debug(f"Cookie. JWT: {token}")
     if not token:
         auth_header = request.headers.get("Authorization")
         if not auth_header or not auth_header.startswith("Bearer "):
             return False
         token = auth_header.split(" ")[1]
-        logger.debug(f"Bearer. JWT: {token}")
 
-    token_parts = False
-    try:
-        token_parts = jwt.decode(token, env.JWT_SECRET_KEY)
-        return token_parts
-    except JoseError:
+    global token_cache_rejects
+    digest = hashlib.sha256(token.encode()).digest()
+    token_parts = verified_token_cache.get(digest)
+    if token_parts is None:
+        try:
+            token_parts = jwt.decode(token, env.JWT_SECRET_KEY)
+            CLAIMS_REGISTRY.validate(token_parts.claims)
+        except (JoseError, ValueError):
+            # remember bad tokens briefly so retries don't cost a signature check each
+            token_parts = INVALID_TOKEN
+            verified_token_cache.set(digest, INVALID_TOKEN, ttl=env.TOKEN_CACHE_NEGATIVE_TTL_S)
+        else:
+            ttl = env.TOKEN_CACHE_TTL_S
+            if 'exp' in token_parts.claims:
+                ttl = min(ttl, token_parts.claims['exp'] - time.time())
+            if ttl > 0:
+                verified_token_cache.set(digest, token_parts, ttl=ttl)
+
+    if token_parts is INVALID_TOKEN:
+        token_cache_rejects += 1
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or missing Authorization header",
         )
+    return token_parts
+
+def token_cache_stats() -> dict:
+    return {**verified_token_cache.stats(), 'rejects': token_cache_rejects}
 
 
 def encode_token(payload: Dict):
+    payload = {'exp': int(time.time()) + env.JWT_TTL_S, **payload}
     return jwt.encode({'alg': 'HS256'}, payload, env.JWT_SECRET_KEY)
 
 async def verify_query_is_correct(params, query_hash):
@@ -1,12 +1,67 @@
+import time
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 import json
 from env_settings import env
+from metrics import instrument_engine, pool_stats
 
 DATABASE_URL = env.DATABASE_URL_asyncpg
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_s_total = 0.0
+        self.wait_s_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait_s = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_s_total += wait_s
+            self.wait_s_max = max(self.wait_s_max, wait_s)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "max_overflow": self._max_overflow,
+            "timeout_s": self.timeout(),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_s_average": self.wait_s_total / self.checkouts if self.checkouts else 0.0,
+            "wait_s_max": self.wait_s_max
+        }
+
+
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=env.DB_ECHO,
+    poolclass=TimedQueuePool,
+    pool_size=env.DB_POOL_SIZE,
+    max_overflow=env.DB_MAX_OVERFLOW,
+    pool_timeout=env.DB_POOL_TIMEOUT_S,
+    pool_recycle=env.DB_POOL_RECYCLE_S,
+    pool_pre_ping=env.DB_POOL_PRE_PING,
+    connect_args={"prepared_statement_cache_size": env.DB_STATEMENT_CACHE_SIZE}
+)
+instrument_engine(engine.sync_engine)
+pool_stats.add('main', engine.pool.stats)
 AsyncSessionLocal = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 Base = declarative_base()
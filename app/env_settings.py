@@ -4,15 +4,49 @@ class EnvSettings(BaseSettings):
     BOT_USERNAME: str
     BOT_ADMIN_ID: int
     DEBUG: bool = False
+    # root level, DEBUG or INFO after the DEBUG flag when unset
+    LOG_LEVEL: str | None = None
+    # per logger levels, e.g. {"sqlalchemy.engine": "INFO", "uvicorn.access": "WARNING"}
+    LOG_LEVELS: dict[str, str] = {}
+    LOG_FORMAT: str = 'json'
+    # DEBUG records allowed per second for each logger and message template
+    LOG_RATE_LIMIT_PER_S: float = 5
+    LOG_RATE_LIMIT_BURST: int = 20
     DOMAIN_NAME: str
     JWT_SECRET_KEY: str
     COOKIE_NAME: str
+    JWT_TTL_S: int = 7 * 24 * 3600
+    TOKEN_CACHE_SIZE: int = 50000
+    TOKEN_CACHE_TTL_S: float = 3600
+    TOKEN_CACHE_NEGATIVE_TTL_S: float = 30
     DB_DRIVER: str
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
     POSTGRES_DB: str
     POSTGRES_PORT: int
     POSTGRES_HOST: str
+    DB_ECHO: bool = False
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT_S: float = 30
+    DB_POOL_RECYCLE_S: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    # asyncpg prepared statements kept per connection, 0 disables them (needed behind pgbouncer)
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    TRACK_OWNER_CACHE_SIZE: int = 100000
+    TRACK_OWNER_CACHE_TTL_S: float = 600
+    USER_ID_CACHE_SIZE: int = 100000
+    SIMPLIFIED_TRACK_CACHE_SIZE: int = 2000
+    SIMPLIFIED_TRACK_CACHE_TTL_S: float = 3600
+    SIMPLIFIED_TRACK_CACHE_ZOOM_LEVELS: int = 8
+    COORDINATES_STREAM_PARTITION_SIZE: int = 2000
+    TILE_CACHE_SIZE: int = 20000
+    TILE_CACHE_TTL_S: float = 3600
+    LOCATIONS_PARTITION_MONTHS_AHEAD: int = 3
+    LOCATIONS_PARTITION_MAINTENANCE_INTERVAL_S: float = 6 * 3600
+    # detach monthly locations partitions older than this many months, None keeps them attached
+    LOCATIONS_PARTITION_DETACH_AFTER_MONTHS: int | None = None
+    LOCATIONS_PARTITION_DETACH_LOCK_TIMEOUT_MS: int = 2000
 
     @property
     def DATABASE_URL_asyncpg(self):
@@ -0,0 +1,43 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi.requests import Request
+
+
+def make_etag(*parts) -> str:
+    """Weak ETag over the given parts, weak so nginx gzip keeps it"""
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:24]
+    return f'W/"{digest}"'
+
+
+def validator_headers(etag: str, last_modified: datetime | None) -> dict:
+    headers = {
+        'ETag': etag,
+        # cache, but always revalidate since live tracks keep changing
+        'Cache-Control': 'private, no-cache'
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime | None) -> bool:
+    """Evaluate If-None-Match, or If-Modified-Since when no If-None-Match was sent"""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*':
+            return True
+        opaque = etag.removeprefix('W/')
+        return any(tag.strip().removeprefix('W/') == opaque for tag in if_none_match.split(','))
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+    return False
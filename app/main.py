@@ -3,27 +3,80 @@ import uvicorn
 from env_settings import env
 from app_logger import logger
 
+import asyncio
 import json
+import time
 import urllib.parse
-from fastapi import HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import HTTPException, Query
+from datetime import datetime, timezone
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.requests import Request
 from fastapi.templating import Jinja2Templates
 
 
-from auth import auth_router, verify_init_data_is_correct, encode_token, process_token
+from auth import auth_router, verify_init_data_is_correct, encode_token, process_token, token_cache_stats
 
 
 from fastapi import Depends
-from database import get_db
+from database import get_db, engine, AsyncSessionLocal
 from schemas import RecordLocation, CreateTrack, StopTrack
-from queries.locations import get_tracks_by_user_id, get_coordinates_by_track_id, record_location, start_track, calculate_speeds_for_track, calculate_track_statistics
-from queries.db_user_access import get_user_id_by_telegram_id
+from queries.locations import get_tracks_by_user_id, get_coordinates_by_track_id, get_simplified_coordinates_by_track_id, stream_coordinates_by_track_id, get_track_version, get_tracks_version, record_location, record_locations_batch, start_track, finalize_track_statistics, check_track_statistics
+from queries.locations import simplified_track_cache
+from queries.db_user_access import get_user_id_by_telegram_id, track_owner_cache, user_id_cache
+from queries.tiles import get_tracks_tile, tile_cache
+from queries.search import search_tracks
+from queries.partitions import create_locations_partitions, detach_locations_partitions
+from error_handlers import SessionAccessError
+from track_simplify import zoom_for_tolerance, MAX_ZOOM
+from http_cache import make_etag, validator_headers, is_not_modified
+from track_encoding import encode_track_polyline, encode_track_binary, POLYLINE_MEDIA_TYPE, BINARY_MEDIA_TYPE, NDJSON_MEDIA_TYPE, BINARY_FORMAT_VERSION
+from metrics import REQUEST_LATENCY, REQUESTS_IN_FLIGHT, LOCATIONS_RECEIVED, LOCATIONS_INSERTED, cache_stats
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 
-app = FastAPI()
+async def maintain_locations_partitions():
+    """Keep partitions ahead of incoming points and detach expired ones"""
+    while True:
+        try:
+            async with AsyncSessionLocal() as session:
+                created = await create_locations_partitions(session, env.LOCATIONS_PARTITION_MONTHS_AHEAD)
+            if created:
+                logger.info("Created %d locations partitions", created)
+            if env.LOCATIONS_PARTITION_DETACH_AFTER_MONTHS is not None:
+                now = datetime.now(timezone.utc)
+                months = now.year * 12 + now.month - 1 - env.LOCATIONS_PARTITION_DETACH_AFTER_MONTHS
+                detached = await detach_locations_partitions(
+                    engine,
+                    datetime(months // 12, months % 12 + 1, 1, tzinfo=timezone.utc),
+                    env.LOCATIONS_PARTITION_DETACH_LOCK_TIMEOUT_MS
+                )
+                if detached:
+                    logger.info("Detached locations partitions %s", detached)
+        except Exception as e:
+            logger.error("Locations partition maintenance failed: %s", e, exc_info=True)
+        await asyncio.sleep(env.LOCATIONS_PARTITION_MAINTENANCE_INTERVAL_S)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    partition_maintenance = asyncio.create_task(maintain_locations_partitions())
+    yield
+    partition_maintenance.cancel()
+    try:
+        await partition_maintenance
+    except asyncio.CancelledError:
+        pass
+
+app = FastAPI(lifespan=lifespan)
+
+cache_stats.add('verified_token', token_cache_stats)
+cache_stats.add('track_owner', track_owner_cache.stats)
+cache_stats.add('user_id', user_id_cache.stats)
+cache_stats.add('simplified_track', simplified_track_cache.stats)
+cache_stats.add('tile', tile_cache.stats)
 
 templates = Jinja2Templates('html_files')
 static_files = StaticFiles(directory='static_files')
@@ -39,7 +92,7 @@ app.mount('/auth', auth_router)
 @app.middleware('http')
 async def middleware(request: Request, call_next):
     # Bypass auth for auth routes, static files, and docs
-    if request.url.path.startswith(('/auth', '/webapp', '/docs', '/openapi.json')):
+    if request.url.path.startswith(('/auth', '/webapp', '/docs', '/openapi.json', '/health', '/metrics')):
         return await call_next(request)
 
     # Handle WebApp flow
@@ -53,8 +106,13 @@ async def middleware(request: Request, call_next):
         if token_parts:
             request.state.user_id = token_parts.claims['user_id']
             return await call_next(request)
+    except HTTPException as e:
+        # expired and rejected tokens are routine, their owners just see the login wall
+        if e.status_code != 401:
+            raise
+        logger.debug("Rejected token: %s", e.detail)
     except Exception as e:
-        logger.error(f"Error processing token: {str(e)}", exc_info=True)
+        logger.error("Error processing token: %s", e, exc_info=True)
 
     # Not authenticated - show login wall
     url_safe_path = urllib.parse.quote(request.url.path, safe='')
@@ -63,11 +121,51 @@ async def middleware(request: Request, call_next):
         'next_path': url_safe_path,
         'bot_username': env.BOT_USERNAME
     })
+
+# Added after the auth middleware so it wraps it and times the login wall too
+@app.middleware('http')
+async def metrics_middleware(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        # the route template, not the path, keeps track ids out of the labels
+        route = request.scope.get('route')
+        REQUEST_LATENCY.labels(request.method, route.path if route else 'unmatched', str(status)).observe(
+            time.perf_counter() - start)
+
 @app.get("/")
 async def read_root():
     return {"message": "Hello from FastAPI!"}
 
 
+@app.get("/health/db")
+async def db_health():
+    """Endpoint to report connection pool usage and the latency of a trivial query,
+    blocked in nginx like /metrics"""
+    start = time.perf_counter()
+    try:
+        async with AsyncSessionLocal() as session:
+            await session.execute(text("SELECT 1"))
+    except Exception as e:
+        logger.error("Database health check failed: %s", e, exc_info=True)
+        return JSONResponse({"ok": False, "message": "Database unavailable", "pool": engine.pool.stats()},
+                            status_code=503)
+
+    return {"ok": True, "query_s": time.perf_counter() - start, "pool": engine.pool.stats()}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Endpoint for Prometheus, blocked in nginx and scraped from inside the network"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/webapp", response_class=HTMLResponse)
 async def webapp_interface(request: Request):
     #return templates.TemplateResponse("webapp.html", {"request": request, "title": "Telegram WebApp"})
@@ -77,15 +175,14 @@ async def webapp_interface(request: Request):
 async def webapp_auth(request: Request, 
                       db: AsyncSession = Depends(get_db)
                       ):
-    logger.info("Received webapp-auth request")
+    logger.debug("Received webapp-auth request")
 
     try:
         body = await request.body()
         body_str = body.decode()
-        logger.debug(f"Raw request body: {body_str}")
 
+        # initData carries the user's profile and a signature, never log it
         init_data = dict(urllib.parse.parse_qsl(body_str))
-        logger.info(f"Parsed initData: {init_data}")
         #'''
         if not init_data.get('hash'):
             logger.warning("Missing hash in initData")
@@ -93,7 +190,7 @@ async def webapp_auth(request: Request,
 
         # Verification
         verification_result = await verify_init_data_is_correct(init_data)
-        logger.info(f"Verification result: {verification_result}")
+        logger.debug("Verification result: %s", verification_result)
 
         if not verification_result:
             logger.warning("initData verification failed")
@@ -101,25 +198,24 @@ async def webapp_auth(request: Request,
 
         # User data extraction
         user_data_str = init_data.get('user', '{}')
-        logger.debug(f"Raw user data: {user_data_str}")
 
         try:
             user_data = json.loads(user_data_str)
             telegram_id = user_data.get('id')
-            logger.info(f"Extracted user ID: {telegram_id}")
+            logger.debug("Extracted telegram id %s", telegram_id)
 
             if not telegram_id:
                 logger.error("User ID not found in initData")
                 raise ValueError("User ID not found")
 
         except (json.JSONDecodeError, ValueError) as e:
-            logger.error(f"User data parsing failed: {str(e)}")
+            logger.error("User data parsing failed: %s", e)
             raise HTTPException(status_code=400, detail="Invalid user data in initData")
         #'''
         user_id = await get_user_id_by_telegram_id(session=db, telegram_id=telegram_id)
         # Token generation
         token = encode_token({'user_id': user_id})
-        logger.info(f"Generated JWT token for user {user_id}")
+        logger.debug("Generated JWT token for user %s", user_id)
 
         response_data = {
             "status": "authenticated",
@@ -127,13 +223,13 @@ async def webapp_auth(request: Request,
             "user_id": user_id
         }
 
-        logger.info("Authentication successful")
+        logger.info("Authentication successful", extra={"user_id": user_id})
         return JSONResponse(response_data)
 
     except HTTPException:
         raise  # Re-raise already logged HTTP exceptions
     except Exception as e:
-        logger.error(f"Unexpected error in webapp_auth: {str(e)}", exc_info=True)
+        logger.error("Unexpected error in webapp_auth: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/track/location")
@@ -146,9 +242,28 @@ async def record_location_for_track(
     """Endpoint to create a new location record"""
     new_loc = await record_location(session=db, track_id=location_data.track_id, user_id=user_id, latitude=location_data.latitude,
                                     longitude=location_data.longitude, custom_timestamp=location_data.device_timestamp, is_paused=location_data.is_paused)
+    LOCATIONS_RECEIVED.labels('single').inc()
+    LOCATIONS_INSERTED.labels('single').inc()
     return {"message": "Location added"}
 
 
+@app.post("/track/locations/batch")
+async def record_locations_for_tracks(
+    locations_data: list[RecordLocation],
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    user_id = request.state.user_id
+    """Endpoint to create many location records in one transaction"""
+    try:
+        inserted = await record_locations_batch(session=db, user_id=user_id, locations=locations_data)
+    except SessionAccessError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    LOCATIONS_RECEIVED.labels('batch').inc(len(locations_data))
+    LOCATIONS_INSERTED.labels('batch').inc(inserted)
+    return {"message": "Locations added", "received": len(locations_data), "inserted": inserted}
+
+
 @app.post("/track/start_track")
 async def start_new_track(
     track_data: CreateTrack,
@@ -162,52 +277,217 @@ async def start_new_track(
     return {"message": "Track created", "track_id": new_track_id}
 
 
+def encode_tracks_cursor(start_timestamp: datetime, track_id: int) -> str:
+    return f"{start_timestamp.isoformat()},{track_id}"
+
+def decode_tracks_cursor(cursor: str) -> tuple[datetime, int]:
+    start_timestamp, track_id = cursor.rsplit(",", 1)
+    return datetime.fromisoformat(start_timestamp), int(track_id)
+
+def track_summary_to_dict(s) -> dict:
+    return {
+        "track_id": s.track_id,
+        "start_timestamp": s.start_timestamp.isoformat(),
+        "distance_m_total": s.distance_m_total,
+        "speed_mps_average": s.speed_mps_average,
+        "speed_mps_max": s.speed_mps_max,
+        "duration_s_active": s.duration_s_active,
+        "duration_s_total": s.duration_s_total,
+        "finished": s.finished
+    }
+
 @app.get("/track/tracks")
 async def get_user_tracks(
     request: Request,
+    response: Response,
+    after: str | None = None,
+    limit: int = Query(50, ge=1, le=500),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        user_id = request.state.user_id
+        """Endpoint to list track summaries page by page, newest first.
+
+        after is the next cursor returned with the previous page.
+        """
+        last_modified, tracks_count = await get_tracks_version(session=db, user_id=user_id)
+        etag = make_etag('tracks', user_id, last_modified, tracks_count, after, limit)
+        cache_headers = validator_headers(etag, last_modified)
+        if is_not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=cache_headers)
+
+        user_tracks = await get_tracks_by_user_id(session=db, user_id=user_id,
+                                                  after=decode_tracks_cursor(after) if after else None,
+                                                  limit=limit)
+        r = [track_summary_to_dict(s) for s in user_tracks]
+        next_cursor = None
+        if len(user_tracks) == limit:
+            next_cursor = encode_tracks_cursor(user_tracks[-1].start_timestamp, user_tracks[-1].track_id)
+        # validators only go with a successful body, a cached error would revalidate as is
+        response.headers.update(cache_headers)
+    except Exception as e:
+        return {"error": True, "message": e}
+
+    return {"error": False, "result": r, "next": next_cursor}
+
+def parse_bbox(bbox: str) -> tuple[float, float, float, float]:
+    """min_lon,min_lat,max_lon,max_lat"""
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be min_lon,min_lat,max_lon,max_lat")
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise HTTPException(status_code=400, detail="bbox out of range")
+    return min_lon, min_lat, max_lon, max_lat
+
+@app.get("/track/search")
+async def search_user_tracks(
+    request: Request,
+    bbox: str | None = None,
+    lon: float | None = Query(None, ge=-180, le=180),
+    lat: float | None = Query(None, ge=-90, le=90),
+    radius_m: float | None = Query(None, gt=0, le=1_000_000),
+    after: str | None = None,
+    limit: int = Query(50, ge=1, le=500),
     db: AsyncSession = Depends(get_db)
 ):
+    """Endpoint to find tracks passing through a bbox, or within radius_m of lon/lat, newest first"""
+    if bbox is not None:
+        search_area = {"bbox": parse_bbox(bbox)}
+    elif lon is not None and lat is not None and radius_m is not None:
+        search_area = {"point": (lon, lat), "radius_m": radius_m}
+    else:
+        raise HTTPException(status_code=400, detail="Pass bbox, or lon, lat and radius_m")
+
     try:
         user_id = request.state.user_id
-        """Endpoint to create a new location record"""
-        user_tracks = await get_tracks_by_user_id(session=db, user_id=user_id)
-        r = [{"track_id": s.track_id,
-              "start_timestamp": s.start_timestamp.isoformat(),
-              "distance_m_total": s.distance_m_total,
-              "speed_mps_average": s.speed_mps_average,
-              "speed_mps_max": s.speed_mps_max,
-              "duration_s_active": s.duration_s_active,
-              "duration_s_total": s.duration_s_total
-              } for s in user_tracks]
+        tracks = await search_tracks(session=db, user_id=user_id,
+                                     after=decode_tracks_cursor(after) if after else None,
+                                     limit=limit, **search_area)
+        r = [track_summary_to_dict(s) for s in tracks]
+        next_cursor = None
+        if len(tracks) == limit:
+            next_cursor = encode_tracks_cursor(tracks[-1].start_timestamp, tracks[-1].track_id)
     except Exception as e:
         return {"error": True, "message": e}
 
-    return {"error": False, "result": json.dumps(r)}
+    return {"error": False, "result": r, "next": next_cursor}
+
+def negotiate_coordinates_format(request: Request, format: str | None) -> str:
+    """Pick 'binary', 'polyline', 'ndjson' or 'json' from the format parameter or the Accept header"""
+    if format in ('binary', 'polyline', 'ndjson', 'json'):
+        return format
+    accept = request.headers.get('accept', '')
+    if BINARY_MEDIA_TYPE in accept:
+        return 'binary'
+    if POLYLINE_MEDIA_TYPE in accept:
+        return 'polyline'
+    if NDJSON_MEDIA_TYPE in accept:
+        return 'ndjson'
+    return 'json'
+
+def coordinate_to_dict(c) -> dict:
+    return {
+        "lon": c[0],
+        "lat": c[1],
+        "t": c[2].isoformat(),
+        "p": c[3],
+        "s": c[4]
+    }
+
+async def stream_ndjson_coordinates(track_id: int, user_id: int):
+    """NDJSON lines of a track, one chunk per cursor partition.
+
+    Uses its own session because the request's one is closed once the
+    endpoint returns, before the body is streamed.
+    """
+    async with AsyncSessionLocal() as session:
+        async for partition in stream_coordinates_by_track_id(session, track_id, user_id):
+            yield ''.join(json.dumps(coordinate_to_dict(c)) + '\n' for c in partition)
 
 @app.get("/track/{track_id}/coordinates")
 async def get_track_coordinates(
     track_id: int,
     request: Request,
+    response: Response,
+    format: str | None = None,
+    tolerance: float | None = None,
+    zoom: int | None = Query(None, ge=0, le=MAX_ZOOM),
     db: AsyncSession = Depends(get_db)
 ):
     try:
         user_id = request.state.user_id
-        """Endpoint to create a new location record"""
-        coordinates = await get_coordinates_by_track_id(session=db, track_id=track_id, user_id = user_id)
-        processed_coordinates = [{
-            "lon": c[0],
-            "lat": c[1],
-            "t": c[2].isoformat(),
-            "p": c[3],
-            "s": c[4]
-        }
-        for c in coordinates]
+        """Endpoint to get track coordinates as JSON, NDJSON stream, encoded polyline or packed binary.
+
+        tolerance (meters) or zoom (map zoom level) return a simplified line.
+        A tolerance is served by the zoom level simplified no coarser than it.
+        """
+        if zoom is None and tolerance is not None and tolerance > 0:
+            zoom = zoom_for_tolerance(tolerance)
+        response_format = negotiate_coordinates_format(request, format)
+
+        # Answer revalidations from the tracks row alone, without reading locations
+        last_modified = await get_track_version(session=db, track_id=track_id, user_id=user_id)
+        etag = make_etag('coordinates', track_id, last_modified, response_format, zoom, BINARY_FORMAT_VERSION)
+        headers = {'Vary': 'Accept', **validator_headers(etag, last_modified)}
+        if is_not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+
+        if response_format == 'ndjson' and zoom is None:
+            return StreamingResponse(stream_ndjson_coordinates(track_id, user_id),
+                                     media_type=NDJSON_MEDIA_TYPE, headers=headers)
+        if zoom is not None:
+            coordinates = await get_simplified_coordinates_by_track_id(session=db, track_id=track_id, user_id=user_id,
+                                                                       zoom=zoom)
+        else:
+            coordinates = await get_coordinates_by_track_id(session=db, track_id=track_id, user_id = user_id)
+        if response_format == 'binary':
+            return Response(encode_track_binary(coordinates), media_type=BINARY_MEDIA_TYPE,
+                            headers=headers)
+        if response_format == 'polyline':
+            return JSONResponse({"error": False, "result": encode_track_polyline(coordinates)},
+                                media_type=POLYLINE_MEDIA_TYPE, headers=headers)
+        if response_format == 'ndjson':
+            return Response(''.join(json.dumps(coordinate_to_dict(c)) + '\n' for c in coordinates),
+                            media_type=NDJSON_MEDIA_TYPE, headers=headers)
+        processed_coordinates = [coordinate_to_dict(c) for c in coordinates]
+        response.headers.update(headers)
 
     except Exception as e:
         return {"error": True, "message": e}
 
     return {"error": False, "result": json.dumps(processed_coordinates)}
 
+@app.get("/tiles/{z}/{x}/{y}.mvt")
+async def get_user_tracks_tile(
+    z: int,
+    x: int,
+    y: int,
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """Endpoint to get a vector tile with all tracks of the user"""
+    if not 0 <= z <= MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise HTTPException(status_code=404, detail="Tile out of range")
+    user_id = request.state.user_id
+    tile = await get_tracks_tile(session=db, user_id=user_id, z=z, x=x, y=y)
+    return Response(tile, media_type="application/vnd.mapbox-vector-tile")
+
+@app.get("/track/{track_id}/statistics/check")
+async def check_track_statistics_consistency(
+    track_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        user_id = request.state.user_id
+        """Endpoint to compare running track statistics with a full recompute"""
+        result = await check_track_statistics(session=db, track_id=track_id, user_id=user_id)
+    except Exception as e:
+        return {"error": True, "message": e}
+
+    return {"error": False, "result": result}
+
 @app.post("/track/stop_track")
 async def stop_existing_track(
     data: StopTrack,
@@ -216,8 +496,7 @@ async def stop_existing_track(
 ):
     try:
         user_id = request.state.user_id
-        await calculate_speeds_for_track(session=db, track_id=data.track_id, user_id=user_id)
-        statistics = await calculate_track_statistics(session=db, track_id=data.track_id, user_id=user_id)
+        statistics = await finalize_track_statistics(session=db, track_id=data.track_id, user_id=user_id)
 
 
     except Exception as e:
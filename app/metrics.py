@@ -0,0 +1,78 @@
+import re
+import time
+from functools import lru_cache
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+
+REQUEST_LATENCY = Histogram(
+    'aluwa_http_request_duration_seconds', 'Time until the response starts, per route template',
+    ['method', 'route', 'status']
+)
+REQUESTS_IN_FLIGHT = Gauge('aluwa_http_requests_in_flight', 'Requests being handled')
+LOCATIONS_RECEIVED = Counter('aluwa_locations_received_total', 'Points received for recording', ['endpoint'])
+LOCATIONS_INSERTED = Counter('aluwa_locations_inserted_total', 'Points stored, duplicates excluded', ['endpoint'])
+DB_QUERY_LATENCY = Histogram(
+    'aluwa_db_query_duration_seconds', 'Cursor execution time per statement label',
+    ['statement'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+
+STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=2048)
+def statement_label(statement: str) -> str:
+    """'SELECT tracks', 'INSERT locations'... from the statement verb and its first table"""
+    words = statement.split(None, 1)
+    if not words:
+        return 'unknown'
+    verb = words[0].upper()
+    table = STATEMENT_TABLE.search(statement)
+    return f"{verb} {table.group(1)}" if table else verb
+
+
+def instrument_engine(engine):
+    """Time every cursor execution of the engine.
+
+    execution_options(statement_label=...) overrides the label derived from
+    the SQL text.
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_start_time = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        label = context.execution_options.get('statement_label') or statement_label(statement)
+        DB_QUERY_LATENCY.labels(label).observe(time.perf_counter() - context.metrics_start_time)
+
+
+class StatsCollector:
+    """Exports dicts of numbers such as TTLCache.stats() as gauges, read at scrape time"""
+
+    def __init__(self, prefix: str, documentation: str, label: str):
+        self.prefix = prefix
+        self.documentation = documentation
+        self.label = label
+        self.sources = {}
+
+    def add(self, name: str, stats):
+        self.sources[name] = stats
+
+    def collect(self):
+        families = {}
+        for name, stats in self.sources.items():
+            for key, value in stats().items():
+                if key not in families:
+                    families[key] = GaugeMetricFamily(f'{self.prefix}_{key}', f'{self.documentation}: {key}',
+                                                      labels=[self.label])
+                families[key].add_metric([name], value)
+        return families.values()
+
+
+cache_stats = StatsCollector('aluwa_cache', 'In-process cache', 'cache')
+pool_stats = StatsCollector('aluwa_db_pool', 'Database connection pool', 'pool')
+REGISTRY.register(cache_stats)
+REGISTRY.register(pool_stats)
@@ -0,0 +1,29 @@
+"""add updated_at to tracks
+
+Revision ID: 0e6d3a9c5b18
+Revises: 8b1f4c7e2d90
+Create Date: 2025-08-09 12:20:53.671042
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2 # add geoalchemy to the migration file
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0e6d3a9c5b18'
+down_revision: Union[str, Sequence[str], None] = '8b1f4c7e2d90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('tracks', sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('tracks', 'updated_at')
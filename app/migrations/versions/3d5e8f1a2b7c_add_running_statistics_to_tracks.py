@@ -0,0 +1,40 @@
+"""add running statistics to tracks
+
+Revision ID: 3d5e8f1a2b7c
+Revises: c10031ea57e4
+Create Date: 2025-08-04 19:12:41.507316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2 # add geoalchemy to the migration file
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3d5e8f1a2b7c'
+down_revision: Union[str, Sequence[str], None] = 'c10031ea57e4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('tracks', sa.Column('last_longitude', sa.Float(), nullable=True))
+    op.add_column('tracks', sa.Column('last_latitude', sa.Float(), nullable=True))
+    op.add_column('tracks', sa.Column('last_timestamp', sa.DateTime(timezone=True), nullable=True))
+    op.add_column('tracks', sa.Column('last_is_paused', sa.Boolean(), nullable=True))
+    op.add_column('tracks', sa.Column('stats_dirty', sa.Boolean(), server_default='false', nullable=False))
+
+    # Existing tracks have no running values yet, recompute them fully on stop
+    op.execute("UPDATE tracks SET stats_dirty = true")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('tracks', 'stats_dirty')
+    op.drop_column('tracks', 'last_is_paused')
+    op.drop_column('tracks', 'last_timestamp')
+    op.drop_column('tracks', 'last_latitude')
+    op.drop_column('tracks', 'last_longitude')
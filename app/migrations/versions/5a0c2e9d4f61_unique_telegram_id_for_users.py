@@ -0,0 +1,48 @@
+"""unique telegram_id for users
+
+Revision ID: 5a0c2e9d4f61
+Revises: 3d5e8f1a2b7c
+Create Date: 2025-08-05 11:03:27.918224
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2 # add geoalchemy to the migration file
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5a0c2e9d4f61'
+down_revision: Union[str, Sequence[str], None] = '3d5e8f1a2b7c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # Merge duplicate users created by concurrent logins into the oldest one
+    op.execute("""
+        UPDATE tracks
+        SET user_id = keep.id
+        FROM users dup
+        JOIN (SELECT telegram_id, min(id) AS id FROM users GROUP BY telegram_id) keep
+            ON keep.telegram_id = dup.telegram_id
+        WHERE tracks.user_id = dup.id AND dup.id != keep.id
+    """)
+    op.execute("""
+        DELETE FROM users
+        WHERE id NOT IN (
+            SELECT min(id)
+            FROM users
+            GROUP BY telegram_id
+        )
+        AND telegram_id IS NOT NULL
+    """)
+
+    op.drop_index(op.f('ix_users_telegram_id'), table_name='users')
+    op.create_index(op.f('ix_users_telegram_id'), 'users', ['telegram_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_users_telegram_id'), table_name='users')
+    op.create_index(op.f('ix_users_telegram_id'), 'users', ['telegram_id'], unique=False)
@@ -0,0 +1,29 @@
+"""add index on tracks user_id start_timestamp
+
+Revision ID: 8b1f4c7e2d90
+Revises: 5a0c2e9d4f61
+Create Date: 2025-08-07 18:45:10.224613
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2 # add geoalchemy to the migration file
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b1f4c7e2d90'
+down_revision: Union[str, Sequence[str], None] = '5a0c2e9d4f61'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index('ix_tracks_user_id_start_timestamp', 'tracks', ['user_id', 'start_timestamp'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_tracks_user_id_start_timestamp', table_name='tracks')
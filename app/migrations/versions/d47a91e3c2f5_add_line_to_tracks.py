@@ -0,0 +1,62 @@
+"""add line to tracks
+
+Revision ID: d47a91e3c2f5
+Revises: 0e6d3a9c5b18
+Create Date: 2025-08-12 21:07:36.480217
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2 # add geoalchemy to the migration file
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd47a91e3c2f5'
+down_revision: Union[str, Sequence[str], None] = '0e6d3a9c5b18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# tracks per backfill transaction
+BACKFILL_BATCH_SIZE = 500
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('tracks', sa.Column('line', geoalchemy2.types.Geometry(geometry_type='LINESTRINGM', srid=4326, dimension=3, spatial_index=False, from_text='ST_GeomFromEWKT', name='geometry'), nullable=True))
+    op.create_index('idx_tracks_line', 'tracks', ['line'], unique=False, postgresql_using='gist')
+
+    # Backfill in committed batches of track ids to keep locks and WAL bursts bounded
+    bind = op.get_bind()
+    max_track_id = bind.execute(sa.text("SELECT max(track_id) FROM tracks")).scalar()
+    if max_track_id is None:
+        return
+
+    with op.get_context().autocommit_block():
+        for low in range(0, max_track_id + 1, BACKFILL_BATCH_SIZE):
+            bind.execute(
+                sa.text("""
+                    UPDATE tracks
+                    SET line = lines.line
+                    FROM (
+                        SELECT track_id,
+                               ST_SetSRID(ST_MakeLine(
+                                   ST_MakePointM(ST_X(geom), ST_Y(geom), extract(epoch FROM custom_timestamp))
+                                   ORDER BY custom_timestamp
+                               ), 4326) AS line
+                        FROM locations
+                        WHERE track_id >= :low AND track_id < :high
+                        GROUP BY track_id
+                        HAVING count(*) > 1
+                    ) lines
+                    WHERE tracks.track_id = lines.track_id
+                """),
+                {'low': low, 'high': low + BACKFILL_BATCH_SIZE}
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('idx_tracks_line', table_name='tracks', postgresql_using='gist')
+    op.drop_column('tracks', 'line')
@@ -0,0 +1,154 @@
+"""partition locations by month
+
+Revision ID: f2b8c6d1a9e3
+Revises: d47a91e3c2f5
+Create Date: 2025-08-14 11:52:03.917640
+
+Moves locations to a table range partitioned by custom_timestamp, one
+partition per UTC month named locations_pYYYYMM, plus locations_default for
+points outside of every partition. create_locations_partitions() creates the
+upcoming months and is called by the app periodically, old months can be
+detached with ALTER TABLE locations DETACH PARTITION. CONCURRENTLY is not
+allowed while locations_default exists.
+
+Run with the app stopped, points written during the copy would be lost.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2 # add geoalchemy to the migration file
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2b8c6d1a9e3'
+down_revision: Union[str, Sequence[str], None] = 'd47a91e3c2f5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# tracks per copy transaction
+COPY_BATCH_SIZE = 500
+MONTHS_AHEAD = 3
+
+CREATE_PARTITION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION create_locations_partition(month_start timestamp)
+    RETURNS boolean LANGUAGE plpgsql AS $$
+    DECLARE
+        partition_name text := 'locations_p' || to_char(month_start, 'YYYYMM');
+        lower_bound timestamptz := date_trunc('month', month_start) AT TIME ZONE 'UTC';
+        upper_bound timestamptz := (date_trunc('month', month_start) + interval '1 month') AT TIME ZONE 'UTC';
+    BEGIN
+        IF to_regclass(partition_name) IS NOT NULL THEN
+            RETURN false;
+        END IF;
+        EXECUTE format('CREATE TABLE %I (LIKE locations INCLUDING DEFAULTS)', partition_name);
+        -- points of this month that arrived before the partition existed
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM locations_default
+                            WHERE custom_timestamp >= $1 AND custom_timestamp < $2 RETURNING *)
+             INSERT INTO %I SELECT * FROM moved', partition_name
+        ) USING lower_bound, upper_bound;
+        EXECUTE format('ALTER TABLE locations ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                       partition_name, lower_bound, upper_bound);
+        RETURN true;
+    END $$
+"""
+
+CREATE_PARTITIONS_FUNCTION = """
+    CREATE OR REPLACE FUNCTION create_locations_partitions(months_ahead integer DEFAULT 3)
+    RETURNS integer LANGUAGE plpgsql AS $$
+    DECLARE
+        created integer := 0;
+    BEGIN
+        -- several app workers run this at the same time on startup
+        PERFORM pg_advisory_xact_lock(hashtext('create_locations_partitions'));
+        FOR i IN 0..months_ahead LOOP
+            IF create_locations_partition(date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => i)) THEN
+                created := created + 1;
+            END IF;
+        END LOOP;
+        RETURN created;
+    END $$
+"""
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.rename_table('locations', 'locations_unpartitioned')
+    op.execute("ALTER INDEX IF EXISTS idx_locations_geom RENAME TO idx_locations_unpartitioned_geom")
+    op.execute("ALTER TABLE locations_unpartitioned RENAME CONSTRAINT pk_locations TO pk_locations_unpartitioned")
+
+    op.create_table('locations',
+    sa.Column('track_id', sa.Integer(), nullable=False),
+    sa.Column('custom_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('geom', geoalchemy2.types.Geometry(geometry_type='POINT', srid=4326, spatial_index=False, from_text='ST_GeomFromEWKT', name='geometry'), nullable=True),
+    sa.Column('is_paused', sa.Boolean(), nullable=True),
+    sa.Column('speed_mps', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['track_id'], ['tracks.track_id'], name='locations_track_id_fkey'),
+    sa.PrimaryKeyConstraint('track_id', 'custom_timestamp', name='pk_locations'),
+    postgresql_partition_by='RANGE (custom_timestamp)'
+    )
+    op.create_index('idx_locations_geom', 'locations', ['geom'], unique=False, postgresql_using='gist')
+    op.create_index(op.f('ix_locations_track_id'), 'locations', ['track_id'], unique=False)
+    # points are appended in time order, so block ranges stay tight within a partition
+    op.create_index('ix_locations_custom_timestamp', 'locations', ['custom_timestamp'], unique=False, postgresql_using='brin')
+    op.execute("CREATE TABLE locations_default PARTITION OF locations DEFAULT")
+
+    op.execute(CREATE_PARTITION_FUNCTION)
+    op.execute(CREATE_PARTITIONS_FUNCTION)
+    op.execute("""
+        SELECT create_locations_partition(month_start)
+        FROM generate_series(
+            date_trunc('month', (SELECT min(custom_timestamp) FROM locations_unpartitioned) AT TIME ZONE 'UTC'),
+            date_trunc('month', now() AT TIME ZONE 'UTC'),
+            interval '1 month'
+        ) AS month_start
+    """)
+    op.execute(f"SELECT create_locations_partitions({MONTHS_AHEAD})")
+
+    # Copy in committed batches of track ids, rows are routed to their month's partition
+    bind = op.get_bind()
+    max_track_id = bind.execute(sa.text("SELECT max(track_id) FROM locations_unpartitioned")).scalar()
+    if max_track_id is not None:
+        with op.get_context().autocommit_block():
+            for low in range(0, max_track_id + 1, COPY_BATCH_SIZE):
+                bind.execute(
+                    sa.text("""
+                        INSERT INTO locations (track_id, custom_timestamp, geom, is_paused, speed_mps)
+                        SELECT track_id, custom_timestamp, geom, is_paused, speed_mps
+                        FROM locations_unpartitioned
+                        WHERE track_id >= :low AND track_id < :high
+                    """),
+                    {'low': low, 'high': low + COPY_BATCH_SIZE}
+                )
+
+    op.drop_table('locations_unpartitioned')
+    op.execute("ANALYZE locations")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_table('locations_unpartitioned',
+    sa.Column('track_id', sa.Integer(), nullable=False),
+    sa.Column('custom_timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('geom', geoalchemy2.types.Geometry(geometry_type='POINT', srid=4326, spatial_index=False, from_text='ST_GeomFromEWKT', name='geometry'), nullable=True),
+    sa.Column('is_paused', sa.Boolean(), nullable=True),
+    sa.Column('speed_mps', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['track_id'], ['tracks.track_id'], name='locations_unpartitioned_track_id_fkey')
+    )
+    op.execute("""
+        INSERT INTO locations_unpartitioned (track_id, custom_timestamp, geom, is_paused, speed_mps)
+        SELECT track_id, custom_timestamp, geom, is_paused, speed_mps
+        FROM locations
+    """)
+
+    # detached partitions are left alone, their rows are not copied back
+    op.drop_table('locations')
+    op.execute("DROP FUNCTION create_locations_partitions(integer)")
+    op.execute("DROP FUNCTION create_locations_partition(timestamp)")
+
+    op.rename_table('locations_unpartitioned', 'locations')
+    op.execute("ALTER TABLE locations RENAME CONSTRAINT locations_unpartitioned_track_id_fkey TO locations_track_id_fkey")
+    op.create_primary_key('pk_locations', 'locations', ['track_id', 'custom_timestamp'])
+    op.create_index('idx_locations_geom', 'locations', ['geom'], unique=False, postgresql_using='gist')
+    op.create_index(op.f('ix_locations_track_id'), 'locations', ['track_id'], unique=False)
@@ -1,10 +1,16 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime, Boolean, ForeignKey
+from datetime import datetime, timezone
+from sqlalchemy import Column, Integer, Float, String, DateTime, Boolean, ForeignKey, Index, func
 from geoalchemy2 import Geometry
+from sqlalchemy.orm import deferred
 from database import Base
 
 
 class Location(Base):
     __tablename__ = "locations"
+    # Range partitioned by month in the migrations, see create_locations_partitions()
+    __table_args__ = (
+        Index('ix_locations_custom_timestamp', 'custom_timestamp', postgresql_using='brin'),
+    )
 
     track_id = Column(Integer, ForeignKey('tracks.track_id'), primary_key=True, index=True)
     custom_timestamp = Column(DateTime(timezone=True), primary_key=True)
@@ -16,10 +22,13 @@ class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    telegram_id = Column(Integer, index=True)
+    telegram_id = Column(Integer, index=True, unique=True)
 
 class Track(Base):
     __tablename__ = "tracks"
+    __table_args__ = (
+        Index('ix_tracks_user_id_start_timestamp', 'user_id', 'start_timestamp'),
+    )
 
     track_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'), index=True)
@@ -29,3 +38,15 @@ class Track(Base):
     speed_mps_average = Column(Float)
     duration_s_active = Column(Float)
     duration_s_total = Column(Float)
+    # last recorded point, used to advance the statistics on every new point
+    last_longitude = Column(Float)
+    last_latitude = Column(Float)
+    last_timestamp = Column(DateTime(timezone=True))
+    last_is_paused = Column(Boolean)
+    # set when a point arrived out of order and the running statistics need a full recompute
+    stats_dirty = Column(Boolean, nullable=False, default=False, server_default='false')
+    # bumped on every change of the track or its points, used for ETag/Last-Modified
+    updated_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(),
+                        default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
+    # whole track as one line with epoch seconds as M, built on stop and cleared by new points
+    line = deferred(Column(Geometry(geometry_type='LINESTRINGM', srid=4326, dimension=3)))
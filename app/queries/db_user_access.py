@@ -1,31 +1,38 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 from models import User, Track
 from sqlalchemy.future import select
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import TTLCache
+from env_settings import env
+
+# track_id -> owner user_id, tracks never change owner without forget_track_owner
+track_owner_cache = TTLCache(maxsize=env.TRACK_OWNER_CACHE_SIZE, ttl=env.TRACK_OWNER_CACHE_TTL_S)
+# telegram_id -> user_id, the mapping never changes once created
+user_id_cache = TTLCache(maxsize=env.USER_ID_CACHE_SIZE, ttl=float('inf'))
 
 async def get_user_id_by_telegram_id(
     session: AsyncSession,
     telegram_id: int
 ) -> int:
-    r = await session.execute(
-        select(User)
-        .where(User.telegram_id == telegram_id)
-    )
-    length = len(r.all())
-    if length == 0:
-        new_user = User(
-            telegram_id=telegram_id,
-        )
-        session.add(new_user)
-        await session.commit()
-        await session.refresh(new_user)
-        user_id = new_user.id
-    else:
-        r = await session.execute(
-            select(User)
-            .where(User.telegram_id == telegram_id)
-            .limit(1)
+    user_id = user_id_cache.get(telegram_id)
+    if user_id is not None:
+        return user_id
+
+    # Create the user or fetch the existing one in a single round trip
+    result = await session.execute(
+        insert(User)
+        .values(telegram_id=telegram_id)
+        .on_conflict_do_update(
+            index_elements=[User.telegram_id],
+            set_={'telegram_id': telegram_id}
         )
-        user_id = r.all()[0][0].id
+        .returning(User.id)
+    )
+    user_id = result.scalar_one()
+    await session.commit()
+
+    user_id_cache.set(telegram_id, user_id)
     return user_id
 
 async def can_access_track(
@@ -34,9 +41,22 @@ async def can_access_track(
     track_id: int
 ) -> bool:
     """Check if user owns the track session"""
-    result = await db.execute(
-        select(Track)
-        .where(Track.user_id == user_id)
-        .where(Track.track_id == track_id)
-    )
-    return len(result.scalars().all()) > 0
\ No newline at end of file
+    owner_id = track_owner_cache.get(track_id)
+    if owner_id is None:
+        owner_id = (await db.execute(
+            select(Track.user_id)
+            .where(Track.track_id == track_id)
+            .limit(1)
+        )).scalar()
+        if owner_id is None:
+            return False
+        track_owner_cache.set(track_id, owner_id)
+    return owner_id == user_id
+
+def remember_track_owner(track_id: int, user_id: int) -> None:
+    """Prime the ownership cache, e.g. right after a track is created"""
+    track_owner_cache.set(track_id, user_id)
+
+def forget_track_owner(track_id: int) -> None:
+    """Drop cached ownership, call on track deletion or transfer to another user"""
+    track_owner_cache.invalidate(track_id)
@@ -1,13 +1,42 @@
+import math
 from datetime import datetime
+from typing import AsyncIterator
 from geoalchemy2 import WKTElement
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from models import Location, User, Track  # Import Location model
-from sqlalchemy import func, update, Integer
+from sqlalchemy import func, update, case, cast, or_, tuple_, Integer, Float
+from sqlalchemy.dialects.postgresql import insert, aggregate_order_by
 from app_logger import logger
 
 from error_handlers import SessionAccessError
-from queries.db_user_access import can_access_track
+from queries.db_user_access import can_access_track, remember_track_owner
+from track_statistics import advance_track_statistics, as_aware, TRACK_STATISTICS_FIELDS
+from track_simplify import simplify_track, tolerance_for_zoom
+from cache import TTLCache
+from env_settings import env
+
+# track_id -> {zoom: simplified coordinates}, dropped whenever the track gets new points
+simplified_track_cache = TTLCache(maxsize=env.SIMPLIFIED_TRACK_CACHE_SIZE, ttl=env.SIMPLIFIED_TRACK_CACHE_TTL_S)
+
+# asyncpg caps a statement at 32767 bind parameters, each row binds one per column:
+# track_id, custom_timestamp, geom, is_paused and speed_mps
+MAX_BIND_PARAMETERS = 32767
+LOCATIONS_INSERT_COLUMNS = 5
+LOCATIONS_INSERT_CHUNK_SIZE = MAX_BIND_PARAMETERS // LOCATIONS_INSERT_COLUMNS
+
+# Columns of a track list entry, never the line or the running statistics state
+TRACK_SUMMARY_COLUMNS = (
+    Track.track_id,
+    Track.start_timestamp,
+    Track.distance_m_total,
+    Track.speed_mps_average,
+    Track.speed_mps_max,
+    Track.duration_s_active,
+    Track.duration_s_total,
+    # a stopped track has its line, the null check doesn't read the geometry
+    Track.line.isnot(None).label('finished')
+)
 
 def calculate_segment_duration(start, end):
     return (end - start).total_seconds()
@@ -28,18 +57,100 @@ async def record_location(
     point = WKTElement(f'POINT({longitude} {latitude})', srid=4326)
     timestamp = custom_timestamp if custom_timestamp else datetime.utcnow()
 
+    # Lock the track so concurrent points advance its statistics one at a time
+    track = (await session.execute(
+        select(Track)
+        .where(Track.track_id == track_id)
+        .with_for_update()
+    )).scalar_one()
+
+    speed_mps = advance_track_statistics(track, longitude, latitude, timestamp, is_paused)
+    if speed_mps is None:
+        track.stats_dirty = True
+    # the materialized line no longer covers every point
+    track.line = None
+
     new_location = Location(
         track_id=track_id,
         custom_timestamp=timestamp,
         geom=point,
-        is_paused=is_paused
+        is_paused=is_paused,
+        speed_mps=speed_mps
     )
 
     session.add(new_location)
     await session.commit()
+    simplified_track_cache.invalidate(track_id)
     await session.refresh(new_location)
     return new_location
 
+async def record_locations_batch(
+    session: AsyncSession,
+    user_id: int,
+    locations: list,
+) -> int:
+    """Insert many location records in one transaction.
+
+    Ownership is checked once per distinct track. Rows are written with
+    multi-row INSERTs, and points already stored for the same
+    (track_id, custom_timestamp) are skipped, so client retries are harmless.
+    Running track statistics are advanced the same way as in record_location.
+
+    Returns:
+        Number of rows actually inserted
+    """
+    for track_id in {loc.track_id for loc in locations}:
+        if not await can_access_track(session, user_id, track_id):
+            raise SessionAccessError("User cannot add to this track session")
+
+    tracks = {
+        track.track_id: track
+        for track in (await session.execute(
+            select(Track)
+            .where(Track.track_id.in_({loc.track_id for loc in locations}))
+            .order_by(Track.track_id)
+            .with_for_update()
+        )).scalars()
+    }
+
+    # Advance statistics in time order, each (track_id, timestamp) once
+    points = {}
+    for loc in locations:
+        timestamp = as_aware(loc.device_timestamp if loc.device_timestamp else datetime.utcnow())
+        points.setdefault((loc.track_id, timestamp), loc)
+
+    rows = []
+    for (track_id, timestamp), loc in sorted(points.items()):
+        rows.append({
+            'track_id': track_id,
+            'custom_timestamp': timestamp,
+            'geom': WKTElement(f'POINT({loc.longitude} {loc.latitude})', srid=4326),
+            'is_paused': loc.is_paused,
+            'speed_mps': advance_track_statistics(tracks[track_id], loc.longitude, loc.latitude, timestamp, loc.is_paused)
+        })
+
+    inserted = 0
+    for start in range(0, len(rows), LOCATIONS_INSERT_CHUNK_SIZE):
+        chunk = rows[start:start + LOCATIONS_INSERT_CHUNK_SIZE]
+        result = await session.execute(
+            insert(Location)
+            .values(chunk)
+            .on_conflict_do_nothing(index_elements=['track_id', 'custom_timestamp'])
+            .returning(Location.track_id, Location.speed_mps)
+        )
+        for track_id, speed_mps in result.all():
+            inserted += 1
+            # A stored point older than the track's last one needs a full recompute
+            if speed_mps is None:
+                tracks[track_id].stats_dirty = True
+
+    for track in tracks.values():
+        track.line = None
+    await session.commit()
+    for track_id in tracks:
+        simplified_track_cache.invalidate(track_id)
+    return inserted
+
 async def start_track(
         session: AsyncSession,
         user_id: int,
@@ -49,12 +160,18 @@ async def start_track(
 
     new_track = Track(
         user_id=user_id,
-        start_timestamp=start_timestamp
+        start_timestamp=start_timestamp,
+        distance_m_total=0.0,
+        speed_mps_max=0.0,
+        speed_mps_average=0.0,
+        duration_s_active=0.0,
+        duration_s_total=0.0
     )
     session.add(new_track)
     await session.commit()
     await session.refresh(new_track)
     track_id = new_track.track_id
+    remember_track_owner(track_id, user_id)
     return track_id
 
 
@@ -62,28 +179,55 @@ async def start_track(
 async def get_tracks_by_user_id(
         session: AsyncSession,
         user_id: int,
-        #start_num: int = 0,
-        #rows_num: int = 100
-) -> list[Track]:
+        after: tuple[datetime, int] | None = None,
+        limit: int = 50
+) -> list:
+    """One page of track summaries, newest first.
+
+    Keyset pagination on (start_timestamp, track_id): pass the values of the
+    last row of the previous page as after, backed by the
+    (user_id, start_timestamp) index.
+    """
+    query = select(*TRACK_SUMMARY_COLUMNS).where(Track.user_id == user_id)
+    if after is not None:
+        query = query.where(tuple_(Track.start_timestamp, Track.track_id) < tuple_(*after))
 
     result = await session.execute(
-        select(Track)
-        .where(Track.user_id == user_id)
-        .order_by(Track.start_timestamp.asc())
-        #.limit(start_num, rows_num)
+        query
+        .order_by(Track.start_timestamp.desc(), Track.track_id.desc())
+        .limit(limit)
     )
 
-    return result.scalars().all()
+    return result.all()
 
-async def get_coordinates_by_track_id(
+async def get_track_version(
     session: AsyncSession,
     track_id: int,
     user_id: int,
-) -> list[Location]:
+) -> datetime:
+    """Last write time of a track, read from the tracks row only"""
     if not await can_access_track(session, user_id, track_id):
         raise SessionAccessError("User has no access to this track session")
 
     result = await session.execute(
+        select(Track.updated_at)
+        .where(Track.track_id == track_id)
+    )
+    return result.scalar_one()
+
+async def get_tracks_version(
+    session: AsyncSession,
+    user_id: int,
+) -> tuple[datetime | None, int]:
+    """Last write time over all tracks of a user and their number"""
+    result = await session.execute(
+        select(func.max(Track.updated_at), func.count())
+        .where(Track.user_id == user_id)
+    )
+    return tuple(result.one())
+
+def _coordinates_query(track_id: int):
+    return (
         select(
             func.ST_X(Location.geom).label('longitude'),
             func.ST_Y(Location.geom).label('latitude'),
@@ -94,8 +238,106 @@ async def get_coordinates_by_track_id(
         .where(Location.track_id == track_id)
         .order_by(Location.custom_timestamp.asc())
     )
+
+async def get_coordinates_by_track_id(
+    session: AsyncSession,
+    track_id: int,
+    user_id: int,
+) -> list[Location]:
+    if not await can_access_track(session, user_id, track_id):
+        raise SessionAccessError("User has no access to this track session")
+
+    result = await session.execute(_coordinates_query(track_id))
     return result.all()
 
+async def stream_coordinates_by_track_id(
+    session: AsyncSession,
+    track_id: int,
+    user_id: int,
+    partition_size: int = env.COORDINATES_STREAM_PARTITION_SIZE,
+) -> AsyncIterator[list]:
+    """Yield the coordinates of a track in partitions read through a server-side cursor,
+    so memory stays bounded by partition_size whatever the track length"""
+    if not await can_access_track(session, user_id, track_id):
+        raise SessionAccessError("User has no access to this track session")
+
+    result = await session.stream(
+        _coordinates_query(track_id)
+        .execution_options(yield_per=partition_size)
+    )
+    async for partition in result.partitions(partition_size):
+        yield partition
+
+
+def _speeds_subquery(track_id: int):
+    """Speed of every point of a track, computed from its predecessor in one window pass"""
+    window = {
+        'partition_by': Location.track_id,
+        'order_by': Location.custom_timestamp.asc()
+    }
+    lagged = (
+        select(
+            Location.track_id,
+            Location.custom_timestamp,
+            Location.geom,
+            func.coalesce(Location.is_paused, False).label('is_paused'),
+            func.lag(Location.geom).over(**window).label('prev_geom'),
+            func.coalesce(func.lag(Location.is_paused).over(**window), False).label('prev_is_paused'),
+            func.lag(Location.custom_timestamp).over(**window).label('prev_timestamp')
+        )
+        .where(Location.track_id == track_id)
+        .subquery('lagged')
+    )
+
+    time_diff = cast(func.extract('epoch', lagged.c.custom_timestamp - lagged.c.prev_timestamp), Float)
+
+    # The first point, paused pairs and non-increasing timestamps get zero speed
+    speed_mps = case(
+        (lagged.c.prev_timestamp.is_(None), 0.0),
+        (or_(lagged.c.is_paused, lagged.c.prev_is_paused), 0.0),
+        (time_diff <= 0, 0.0),
+        else_=func.ST_DistanceSphere(lagged.c.prev_geom, lagged.c.geom) / time_diff
+    )
+
+    return (
+        select(
+            lagged.c.track_id,
+            lagged.c.custom_timestamp,
+            speed_mps.label('speed_mps')
+        )
+        .subquery('speeds')
+    )
+
+
+async def get_simplified_coordinates_by_track_id(
+    session: AsyncSession,
+    track_id: int,
+    user_id: int,
+    zoom: int,
+) -> list:
+    """Coordinates simplified for the given map zoom level, cached per zoom level.
+
+    Every track keeps up to SIMPLIFIED_TRACK_CACHE_ZOOM_LEVELS of them, the
+    one cached first is dropped for a new one.
+    """
+    if not await can_access_track(session, user_id, track_id):
+        raise SessionAccessError("User has no access to this track session")
+
+    versions = simplified_track_cache.get(track_id)
+    if versions is not None and zoom in versions:
+        return versions[zoom]
+
+    coordinates = await get_coordinates_by_track_id(session, track_id, user_id)
+    simplified = simplify_track(coordinates, tolerance_for_zoom(zoom))
+
+    if versions is None:
+        versions = {}
+        simplified_track_cache.set(track_id, versions)
+    versions[zoom] = simplified
+    while len(versions) > env.SIMPLIFIED_TRACK_CACHE_ZOOM_LEVELS:
+        del versions[next(iter(versions))]
+    return simplified
+
 
 async def calculate_speeds_for_track(
         session: AsyncSession,
@@ -106,50 +348,17 @@ async def calculate_speeds_for_track(
     if not await can_access_track(session, user_id, track_id):
         raise SessionAccessError("User has no access to this track session")
 
-    # Get all locations for the session ordered by timestamp
-    locations = await session.execute(
-        select(Location)
-        .where(Location.track_id == track_id)
-        .order_by(Location.custom_timestamp.asc())
+    speeds = _speeds_subquery(track_id)
+    await session.execute(
+        update(Location)
+        .where(Location.track_id == speeds.c.track_id)
+        .where(Location.custom_timestamp == speeds.c.custom_timestamp)
+        .values(speed_mps=speeds.c.speed_mps)
+        .execution_options(synchronize_session=False)
     )
-    locations = locations.scalars().all()
-
-    # Calculate speeds for each point (except the first one)
-    for i in range(1, len(locations)):
-        prev_loc = locations[i - 1]
-        current_loc = locations[i]
-
-        # Skip if either point is paused
-        if prev_loc.is_paused or current_loc.is_paused:
-            current_loc.speed_mps = 0.0
-            continue
-
-        # Calculate time difference in seconds
-        time_diff = (current_loc.custom_timestamp - prev_loc.custom_timestamp).total_seconds()
-        if time_diff <= 0:
-            current_loc.speed_mps = 0.0
-            continue
-
-        # Calculate distance using PostGIS function
-        distance_result = await session.execute(
-            select(
-                func.ST_DistanceSphere(
-                    prev_loc.geom,
-                    current_loc.geom
-                )
-            )
-        )
-        distance_m = distance_result.scalar_one()
-
-        # Calculate speed in meters per second
-        speed_mps = distance_m / time_diff
-        current_loc.speed_mps = speed_mps
-
-    # The first point has no speed (or could set to 0)
-    if len(locations) > 0:
-        locations[0].speed_mps = 0.0
 
     await session.commit()
+    simplified_track_cache.invalidate(track_id)
 
 
 async def get_segments_statistics(
@@ -323,9 +532,48 @@ async def calculate_track_statistics(
     # await calculate_speeds_for_track(session, track_id, user_id)
 
     segments_statistics = await get_segments_statistics(session, track_id, user_id)
-    logger.debug(f"Segment statistics: {segments_statistics}")
+    logger.debug("Segment statistics of track %s: %s", track_id, segments_statistics)
+
+    stats = _aggregate_segments_statistics(segments_statistics)
+    stats['speed_mps_max'] = await get_max_speed_for_track(session, track_id, user_id)
+
+    # Restart the running statistics from the latest stored point
+    last_point = (await session.execute(
+        select(
+            func.ST_X(Location.geom).label('longitude'),
+            func.ST_Y(Location.geom).label('latitude'),
+            Location.custom_timestamp,
+            Location.is_paused
+        )
+        .where(Location.track_id == track_id)
+        .order_by(Location.custom_timestamp.desc())
+        .limit(1)
+    )).first()
+
+    # Update the Track record with these statistics
+    await session.execute(
+        update(Track)
+        .where(Track.track_id == track_id)
+        .values(
+            distance_m_total=stats['distance_m_total'],
+            speed_mps_max=stats['speed_mps_max'],
+            speed_mps_average=stats['speed_mps_average'],
+            duration_s_active=stats['duration_s_active'],
+            duration_s_total=stats['duration_s_total'],
+            last_longitude=last_point.longitude if last_point else None,
+            last_latitude=last_point.latitude if last_point else None,
+            last_timestamp=last_point.custom_timestamp if last_point else None,
+            last_is_paused=last_point.is_paused if last_point else None,
+            stats_dirty=False
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+
+    return stats
 
-    # Initialize statistics
+def _aggregate_segments_statistics(segments_statistics: list[dict]) -> dict:
+    """Sum segment statistics into track statistics, speed_mps_max is left at zero"""
     stats = {
         'distance_m_total': 0.0,
         'speed_mps_max': 0.0,
@@ -341,20 +589,99 @@ async def calculate_track_statistics(
             stats['duration_s_active'] += segment.get("duration", 0)
 
     stats['speed_mps_average'] = stats['distance_m_total'] / stats['duration_s_active'] if stats['duration_s_active'] else 0.0
-    stats['speed_mps_max'] = await get_max_speed_for_track(session, track_id, user_id)
+    return stats
+
+async def finalize_track_statistics(
+        session: AsyncSession,
+        track_id: int,
+        user_id: int,
+) -> dict:
+    """Return final statistics of a stopped track.
+
+    The running values kept up to date by record_location are used as is.
+    Only tracks marked stats_dirty (points out of order, or recorded before
+    running statistics existed) fall back to a full recompute.
+    """
+    if not await can_access_track(session, user_id, track_id):
+        raise SessionAccessError("User has no access to this track session")
+
+    track = await session.get(Track, track_id)
+    if track.stats_dirty:
+        await calculate_speeds_for_track(session, track_id, user_id)
+        stats = await calculate_track_statistics(session, track_id, user_id)
+    else:
+        stats = {field: getattr(track, field) or 0.0 for field in TRACK_STATISTICS_FIELDS}
+
+    await build_track_line(session, track_id)
+    return stats
+
+async def build_track_line(
+        session: AsyncSession,
+        track_id: int,
+) -> None:
+    """Materialize the points of a track as one LineStringM, M being epoch seconds.
+
+    Tracks with fewer than two points get no line.
+    """
+    line = (
+        select(
+            func.ST_MakeLine(aggregate_order_by(
+                func.ST_MakePointM(
+                    func.ST_X(Location.geom),
+                    func.ST_Y(Location.geom),
+                    func.extract('epoch', Location.custom_timestamp)
+                ),
+                Location.custom_timestamp.asc()
+            ))
+        )
+        .where(Location.track_id == track_id)
+        .having(func.count() > 1)
+        .scalar_subquery()
+    )
 
-    # Update the Track record with these statistics
     await session.execute(
         update(Track)
         .where(Track.track_id == track_id)
-        .values(
-            distance_m_total=stats['distance_m_total'],
-            speed_mps_max=stats['speed_mps_max'],
-            speed_mps_average=stats['speed_mps_average'],
-            duration_s_active=stats['duration_s_active'],
-            duration_s_total=stats['duration_s_total']
-        )
+        .values(line=func.ST_SetSRID(line, 4326))
+        .execution_options(synchronize_session=False)
     )
     await session.commit()
 
-    return stats
+async def check_track_statistics(
+        session: AsyncSession,
+        track_id: int,
+        user_id: int,
+        rel_tol: float = 1e-6,
+        abs_tol: float = 1e-3
+) -> dict:
+    """Compare the running statistics of a track against a full recompute.
+
+    Nothing is written, stored speeds are ignored and recomputed as well.
+
+    Returns:
+        Dictionary with the overall verdict and a field -> values map of mismatches
+    """
+    if not await can_access_track(session, user_id, track_id):
+        raise SessionAccessError("User has no access to this track session")
+
+    track = await session.get(Track, track_id)
+
+    recomputed = _aggregate_segments_statistics(
+        await get_segments_statistics(session, track_id, user_id)
+    )
+    speeds = _speeds_subquery(track_id)
+    max_speed = (await session.execute(select(func.max(speeds.c.speed_mps)))).scalar()
+    recomputed['speed_mps_max'] = max_speed if max_speed is not None else 0.0
+
+    mismatches = {}
+    for field in TRACK_STATISTICS_FIELDS:
+        incremental = getattr(track, field) or 0.0
+        if not math.isclose(incremental, recomputed[field], rel_tol=rel_tol, abs_tol=abs_tol):
+            mismatches[field] = {'incremental': incremental, 'recomputed': recomputed[field]}
+
+    return {
+        'track_id': track_id,
+        'consistent': not mismatches,
+        'stats_dirty': track.stats_dirty,
+        'mismatches': mismatches
+    }
@@ -0,0 +1,57 @@
+import re
+from datetime import datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, AsyncEngine
+
+PARTITION_NAME = re.compile(r'^locations_p(\d{4})(\d{2})$')
+
+
+async def create_locations_partitions(session: AsyncSession, months_ahead: int) -> int:
+    """Create the partitions of the current and the next months_ahead months, returns how many were missing"""
+    result = await session.execute(text("SELECT create_locations_partitions(:months_ahead)"),
+                                   {'months_ahead': months_ahead})
+    created = result.scalar()
+    await session.commit()
+    return created
+
+
+def partition_month(name: str) -> datetime:
+    year, month = PARTITION_NAME.match(name).groups()
+    return datetime(int(year), int(month), 1, tzinfo=timezone.utc)
+
+
+async def detach_locations_partitions(engine: AsyncEngine, before: datetime, lock_timeout_ms: int) -> list[str]:
+    """Detach monthly partitions that end before the given time.
+
+    Detached partitions stay as standalone tables to dump and drop. Their
+    points disappear from the coordinates endpoints, while stopped tracks
+    keep their statistics and line. DETACH CONCURRENTLY isn't allowed next
+    to locations_default, so each partition is detached in a transaction of
+    its own under lock_timeout, which fails the detach instead of queueing
+    the writes to locations behind it. What was not detached is retried on
+    the next call.
+    """
+    async with engine.connect() as connection:
+        result = await connection.execute(text("""
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'locations'::regclass
+        """))
+        names = sorted(result.scalars())
+        await connection.commit()
+
+        detached = []
+        for name in names:
+            if not PARTITION_NAME.match(name):
+                continue
+            month = partition_month(name)
+            month_end = month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+            if month_end > before:
+                continue
+            async with connection.begin():
+                await connection.execute(text(f"SET LOCAL lock_timeout = {int(lock_timeout_ms)}"))
+                await connection.execute(text(f'ALTER TABLE locations DETACH PARTITION "{name}"'))
+            detached.append(name)
+    return detached
@@ -0,0 +1,79 @@
+import math
+from datetime import datetime
+
+from sqlalchemy import func, and_, union, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from models import Location, Track
+from queries.locations import TRACK_SUMMARY_COLUMNS
+
+# Meters per degree of latitude, and of longitude on the equator
+METERS_PER_DEGREE = 111320.0
+# Longitude degrees shrink towards the poles, keep the search envelope finite
+MIN_COS_LATITUDE = 0.01
+
+
+def make_envelope(min_lon: float, min_lat: float, max_lon: float, max_lat: float):
+    return func.ST_MakeEnvelope(min_lon, min_lat, max_lon, max_lat, 4326)
+
+
+def radius_envelope(lon: float, lat: float, radius_m: float) -> tuple[float, float, float, float]:
+    """Lon/lat box containing the circle, used as the index condition of a radius search"""
+    d_lat = radius_m / METERS_PER_DEGREE
+    d_lon = radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), MIN_COS_LATITUDE))
+    return lon - d_lon, max(lat - d_lat, -90.0), lon + d_lon, min(lat + d_lat, 90.0)
+
+
+async def search_tracks(
+    session: AsyncSession,
+    user_id: int,
+    bbox: tuple[float, float, float, float] | None = None,
+    point: tuple[float, float] | None = None,
+    radius_m: float | None = None,
+    after: tuple[datetime, int] | None = None,
+    limit: int = 50
+) -> list:
+    """Summaries of the user's tracks passing through a bbox or within radius_m of a point, newest first.
+
+    Stopped tracks are matched on their line and live ones on their points,
+    both through their GiST index with the && bounding box operator first,
+    and the exact ST_Intersects or ST_DWithin (on the sphere) only on the
+    candidates. Pages work like get_tracks_by_user_id.
+    """
+    if bbox is not None:
+        envelope = make_envelope(*bbox)
+
+        def matches(geom):
+            return and_(geom.op('&&')(envelope), func.ST_Intersects(geom, envelope))
+    elif point is not None and radius_m is not None:
+        envelope = make_envelope(*radius_envelope(point[0], point[1], radius_m))
+        center = func.geography(func.ST_SetSRID(func.ST_MakePoint(point[0], point[1]), 4326))
+
+        def matches(geom):
+            return and_(geom.op('&&')(envelope),
+                        func.ST_DWithin(func.geography(func.ST_Force2D(geom)), center, radius_m))
+    else:
+        raise ValueError("Either bbox or point with radius_m is required")
+
+    line_matches = (
+        select(Track.track_id)
+        .where(Track.user_id == user_id, matches(Track.line))
+    )
+    point_matches = (
+        select(Location.track_id)
+        .join(Track, Track.track_id == Location.track_id)
+        .where(Track.user_id == user_id, Track.line.is_(None), matches(Location.geom))
+    )
+
+    query = select(*TRACK_SUMMARY_COLUMNS).where(Track.track_id.in_(union(line_matches, point_matches)))
+    if after is not None:
+        query = query.where(tuple_(Track.start_timestamp, Track.track_id) < tuple_(*after))
+
+    result = await session.execute(
+        query
+        .order_by(Track.start_timestamp.desc(), Track.track_id.desc())
+        .limit(limit)
+    )
+
+    return result.all()
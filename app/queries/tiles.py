@@ -0,0 +1,102 @@
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from env_settings import env
+from queries.locations import get_tracks_version
+
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+# Web Mercator world width in meters
+WORLD_SIZE_M = 40075016.68
+
+# (user_id, z, x, y, tracks version) -> tile, a new version simply misses and old tiles age out
+tile_cache = TTLCache(maxsize=env.TILE_CACHE_SIZE, ttl=env.TILE_CACHE_TTL_S)
+
+# Stopped tracks use their materialized line through its GiST index. Live tracks
+# with a point in the tile envelope, widened by the MVT buffer, are found through
+# the locations GiST index, then built from all of their points and clipped by
+# ST_AsMVTGeom. Building from the points in the envelope only would join the
+# points where a track leaves the tile and comes back with a straight segment.
+TRACKS_TILE_QUERY = text("""
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(:z, :x, :y) AS geom,
+               ST_Transform(ST_TileEnvelope(:z, :x, :y, margin => :margin), 4326) AS geom_4326
+    ),
+    lines AS (
+        SELECT tracks.track_id,
+               tracks.start_timestamp,
+               tracks.distance_m_total,
+               ST_Force2D(tracks.line) AS geom
+        FROM tracks
+        CROSS JOIN bounds
+        WHERE tracks.user_id = :user_id
+          AND tracks.line && bounds.geom_4326
+        UNION ALL
+        SELECT tracks.track_id,
+               tracks.start_timestamp,
+               tracks.distance_m_total,
+               ST_MakeLine(locations.geom ORDER BY locations.custom_timestamp) AS geom
+        FROM tracks
+        JOIN locations ON locations.track_id = tracks.track_id
+        WHERE tracks.user_id = :user_id
+          AND tracks.line IS NULL
+          AND EXISTS (
+              SELECT 1
+              FROM locations AS inside
+              CROSS JOIN bounds
+              WHERE inside.track_id = tracks.track_id
+                AND inside.geom && bounds.geom_4326
+          )
+        GROUP BY tracks.track_id
+    ),
+    mvtgeom AS (
+        SELECT lines.track_id,
+               extract(epoch FROM lines.start_timestamp)::bigint AS start_timestamp,
+               lines.distance_m_total,
+               ST_AsMVTGeom(
+                   ST_Simplify(ST_Transform(lines.geom, 3857), :tolerance),
+                   bounds.geom, :extent, :buffer, true
+               ) AS geom
+        FROM lines CROSS JOIN bounds
+    )
+    SELECT ST_AsMVT(mvtgeom.*, 'tracks', :extent, 'geom')
+    FROM mvtgeom
+    WHERE geom IS NOT NULL
+""")
+
+
+async def get_tracks_tile(
+    session: AsyncSession,
+    user_id: int,
+    z: int,
+    x: int,
+    y: int,
+) -> bytes:
+    """Mapbox Vector Tile with the lines of all tracks of a user crossing the tile.
+
+    Lines are simplified to about one tile pixel at the tile's zoom. Tiles are
+    cached per version of the user's tracks, so any track change invalidates them.
+    """
+    version = await get_tracks_version(session, user_id)
+    key = (user_id, z, x, y, version)
+    tile = tile_cache.get(key)
+    if tile is not None:
+        return tile
+
+    result = await session.execute(
+        TRACKS_TILE_QUERY,
+        {
+            'user_id': user_id,
+            'z': z,
+            'x': x,
+            'y': y,
+            'margin': MVT_BUFFER / MVT_EXTENT,
+            'tolerance': WORLD_SIZE_M / 2 ** z / MVT_EXTENT,
+            'extent': MVT_EXTENT,
+            'buffer': MVT_BUFFER
+        }
+    )
+    tile = bytes(result.scalar() or b'')
+    tile_cache.set(key, tile)
+    return tile
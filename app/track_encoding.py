@@ -0,0 +1,91 @@
+import math
+import struct
+
+# Content types served by /track/{track_id}/coordinates besides the default JSON
+POLYLINE_MEDIA_TYPE = 'application/vnd.aluwa.polyline+json'
+BINARY_MEDIA_TYPE = 'application/octet-stream'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+POLYLINE_PRECISION = 1e5
+SPEED_PRECISION = 1e2
+
+# count, first timestamp in epoch seconds
+BINARY_HEADER = struct.Struct('<Id')
+# bumped with every change of the binary layout, part of the coordinates ETag
+BINARY_FORMAT_VERSION = 2
+BINARY_PAUSED_NULL = 255
+
+
+def _encode_signed(value: int) -> str:
+    """One value in the Google encoded polyline format"""
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def encode_polyline_values(values: list[int]) -> str:
+    """Google encoded polyline algorithm applied to the deltas of an integer series"""
+    chunks = []
+    previous = 0
+    for value in values:
+        chunks.append(_encode_signed(value - previous))
+        previous = value
+    return ''.join(chunks)
+
+
+def encode_track_polyline(coordinates) -> dict:
+    """Encode (lon, lat, timestamp, is_paused, speed_mps) rows as polyline strings.
+
+    - points: standard Google polyline of lat/lon pairs with precision 5
+    - t0: first timestamp in epoch milliseconds
+    - t: polyline-encoded millisecond offsets from t0
+    - s: polyline-encoded speeds in cm/s, missing speeds as zero
+    - p: one character per point, '1' paused, '0' moving
+    """
+    if not coordinates:
+        return {'n': 0, 't0': None, 'points': '', 't': '', 's': '', 'p': ''}
+
+    t0 = round(coordinates[0][2].timestamp() * 1000)
+
+    # lat and lon deltas are interleaved point by point
+    points = []
+    previous_lat = previous_lon = 0
+    for c in coordinates:
+        lat = round(c[1] * POLYLINE_PRECISION)
+        lon = round(c[0] * POLYLINE_PRECISION)
+        points.append(_encode_signed(lat - previous_lat))
+        points.append(_encode_signed(lon - previous_lon))
+        previous_lat, previous_lon = lat, lon
+
+    return {
+        'n': len(coordinates),
+        't0': t0,
+        'points': ''.join(points),
+        't': encode_polyline_values([round(c[2].timestamp() * 1000) - t0 for c in coordinates]),
+        's': encode_polyline_values([round((c[4] or 0.0) * SPEED_PRECISION) for c in coordinates]),
+        'p': ''.join('1' if c[3] else '0' for c in coordinates)
+    }
+
+
+def encode_track_binary(coordinates) -> bytes:
+    """Pack (lon, lat, timestamp, is_paused, speed_mps) rows into little-endian columns.
+
+    Layout: uint32 count, float64 first timestamp (epoch seconds), then
+    float32 lon[n], float32 lat[n], float64 seconds from the first timestamp[n],
+    float32 speed[n] (NaN when missing), uint8 paused[n] (255 when missing).
+    """
+    n = len(coordinates)
+    t0 = coordinates[0][2].timestamp() if coordinates else 0.0
+
+    return b''.join((
+        BINARY_HEADER.pack(n, t0),
+        struct.pack(f'<{n}f', *(c[0] for c in coordinates)),
+        struct.pack(f'<{n}f', *(c[1] for c in coordinates)),
+        struct.pack(f'<{n}d', *(c[2].timestamp() - t0 for c in coordinates)),
+        struct.pack(f'<{n}f', *(math.nan if c[4] is None else c[4] for c in coordinates)),
+        bytes(BINARY_PAUSED_NULL if c[3] is None else int(c[3]) for c in coordinates)
+    ))
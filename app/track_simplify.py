@@ -0,0 +1,85 @@
+import math
+
+from track_statistics import EARTH_RADIUS_M
+
+# Web Mercator meters per pixel at zoom 0 on the equator (256 px tiles)
+METERS_PER_PIXEL_ZOOM_0 = 156543.03
+
+
+# highest zoom level a simplified line is made for, as for the tiles
+MAX_ZOOM = 22
+
+
+def tolerance_for_zoom(zoom: int) -> float:
+    """Simplification tolerance in meters matching about one screen pixel at the given zoom"""
+    return METERS_PER_PIXEL_ZOOM_0 / 2 ** zoom
+
+
+def zoom_for_tolerance(tolerance_m: float) -> int:
+    """Lowest zoom level whose tolerance doesn't exceed tolerance_m, so the line is never coarser than asked"""
+    if tolerance_m >= METERS_PER_PIXEL_ZOOM_0:
+        return 0
+    return min(MAX_ZOOM, math.ceil(math.log2(METERS_PER_PIXEL_ZOOM_0 / tolerance_m)))
+
+
+def _segment_distance(px: float, py: float, ax: float, ay: float, bx: float, by: float) -> float:
+    """Distance from point p to segment ab on a plane"""
+    dx = bx - ax
+    dy = by - ay
+    length_sq = dx * dx + dy * dy
+    if length_sq == 0:
+        return math.hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq))
+    return math.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def _douglas_peucker(xs: list[float], ys: list[float], first: int, last: int, tolerance: float, keep: list[bool]):
+    stack = [(first, last)]
+    while stack:
+        a, b = stack.pop()
+        max_distance = 0.0
+        index = a
+        for i in range(a + 1, b):
+            distance = _segment_distance(xs[i], ys[i], xs[a], ys[a], xs[b], ys[b])
+            if distance > max_distance:
+                max_distance = distance
+                index = i
+        if max_distance > tolerance:
+            keep[index] = True
+            stack.append((a, index))
+            stack.append((index, b))
+
+
+def simplify_track(coordinates, tolerance_m: float) -> list:
+    """Douglas-Peucker simplification of (lon, lat, timestamp, is_paused, speed_mps) rows.
+
+    The first and last points, both points around every pause boundary and
+    the fastest and slowest points are always kept, and the line is only
+    simplified between them.
+    """
+    n = len(coordinates)
+    if n <= 2 or tolerance_m <= 0:
+        return list(coordinates)
+
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    for i in range(1, n):
+        if bool(coordinates[i][3]) != bool(coordinates[i - 1][3]):
+            keep[i - 1] = keep[i] = True
+
+    with_speed = [i for i in range(n) if coordinates[i][4] is not None]
+    if with_speed:
+        keep[max(with_speed, key=lambda i: coordinates[i][4])] = True
+        keep[min(with_speed, key=lambda i: coordinates[i][4])] = True
+
+    # Local equirectangular projection to meters, accurate enough at track scale
+    k = EARTH_RADIUS_M * math.pi / 180
+    kx = k * math.cos(math.radians(coordinates[0][1]))
+    xs = [c[0] * kx for c in coordinates]
+    ys = [c[1] * k for c in coordinates]
+
+    anchors = [i for i in range(n) if keep[i]]
+    for first, last in zip(anchors, anchors[1:]):
+        _douglas_peucker(xs, ys, first, last, tolerance_m, keep)
+
+    return [c for c, kept in zip(coordinates, keep) if kept]
@@ -0,0 +1,96 @@
+import math
+from datetime import datetime, timezone
+
+from models import Track
+
+# Radius used by PostGIS ST_DistanceSphere
+EARTH_RADIUS_M = 6370986.0
+
+TRACK_STATISTICS_FIELDS = (
+    'distance_m_total',
+    'speed_mps_max',
+    'speed_mps_average',
+    'duration_s_active',
+    'duration_s_total'
+)
+
+
+def distance_sphere(longitude1: float, latitude1: float, longitude2: float, latitude2: float) -> float:
+    """Great-circle distance in meters, same sphere and formula as ST_DistanceSphere"""
+    lat1 = math.radians(latitude1)
+    lat2 = math.radians(latitude2)
+    dlon = math.radians(longitude2 - longitude1)
+
+    a = math.cos(lat2) * math.sin(dlon)
+    b = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    c = math.sin(lat1) * math.sin(lat2) + math.cos(lat1) * math.cos(lat2) * math.cos(dlon)
+    return EARTH_RADIUS_M * math.atan2(math.sqrt(a * a + b * b), c)
+
+
+def as_aware(timestamp: datetime) -> datetime:
+    """Treat naive timestamps the way asyncpg stores them into timestamptz"""
+    if timestamp.tzinfo is None:
+        return timestamp.astimezone(timezone.utc)
+    return timestamp
+
+
+def advance_track_statistics(
+        track: Track,
+        longitude: float,
+        latitude: float,
+        timestamp: datetime,
+        is_paused: bool
+) -> float | None:
+    """Fold one new point into the running statistics kept on the track.
+
+    Follows the same rules as calculate_speeds_for_track and
+    get_segments_statistics:
+    - a point continuing a segment adds its time delta to duration_s_total,
+      and to distance_m_total/duration_s_active when the segment is active
+    - the first point of a new active segment adds only its distance
+    - speed is zero for the first point and for paused or zero-time pairs
+
+    Returns:
+        Speed of the new point in meters per second, or None when the point
+        is not newer than the last one and the running values can't absorb it
+    """
+    timestamp = as_aware(timestamp)
+    is_paused = bool(is_paused)
+    last_timestamp = track.last_timestamp
+
+    if last_timestamp is not None and timestamp <= last_timestamp:
+        return None
+
+    distance_m_total = track.distance_m_total or 0.0
+    duration_s_active = track.duration_s_active or 0.0
+    duration_s_total = track.duration_s_total or 0.0
+    speed_mps = 0.0
+
+    if last_timestamp is not None:
+        last_is_paused = bool(track.last_is_paused)
+        time_diff = (timestamp - last_timestamp).total_seconds()
+        distance_m = distance_sphere(track.last_longitude, track.last_latitude, longitude, latitude)
+
+        if is_paused == last_is_paused:
+            duration_s_total += time_diff
+            if not is_paused:
+                distance_m_total += distance_m
+                duration_s_active += time_diff
+        elif not is_paused:
+            distance_m_total += distance_m
+
+        if not is_paused and not last_is_paused and time_diff > 0:
+            speed_mps = distance_m / time_diff
+
+    track.distance_m_total = distance_m_total
+    track.duration_s_active = duration_s_active
+    track.duration_s_total = duration_s_total
+    track.speed_mps_max = max(track.speed_mps_max or 0.0, speed_mps)
+    track.speed_mps_average = distance_m_total / duration_s_active if duration_s_active else 0.0
+
+    track.last_longitude = longitude
+    track.last_latitude = latitude
+    track.last_timestamp = timestamp
+    track.last_is_paused = is_paused
+
+    return speed_mps
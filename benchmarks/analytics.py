@@ -0,0 +1,197 @@
+"""Time the track analytics queries on synthetic tracks of growing size.
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    python benchmarks/analytics.py --migrate --output benchmarks/analytics_baseline.json
+    python benchmarks/analytics.py --compare benchmarks/analytics_baseline.json
+
+One track per size is filled from traces.synthetic_trace, then every
+function runs --repeat times in a fresh session. Wall time is the minimum
+and median of those runs. Peak memory comes from one extra run under
+tracemalloc, so it only counts Python allocations and doesn't slow the
+timed runs. Queries are the cursor executions of one run, with the
+track owner cache warm as it is in the app.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from sqlalchemy import event, text
+
+from app_env import use_app, migrate
+from traces import synthetic_trace
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000, 1_000_000)
+# rows per INSERT ... SELECT FROM unnest
+INSERT_CHUNK_SIZE = 100_000
+TELEGRAM_ID_BASE = 1_800_000_000
+
+INSERT_LOCATIONS = text("""
+    INSERT INTO locations (track_id, custom_timestamp, geom, is_paused)
+    SELECT :track_id, fix.ts, ST_SetSRID(ST_MakePoint(fix.lon, fix.lat), 4326), fix.paused
+    FROM unnest(CAST(:ts AS timestamptz[]), CAST(:lon AS float8[]), CAST(:lat AS float8[]),
+                CAST(:paused AS boolean[])) AS fix(ts, lon, lat, paused)
+    ON CONFLICT (track_id, custom_timestamp) DO NOTHING
+""")
+
+query_count = 0
+
+
+def count_queries(engine):
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        global query_count
+        query_count += 1
+
+
+async def create_track(session_factory, size: int, seed: int) -> tuple[int, int]:
+    """A user and a track with size synthetic fixes, returns (user_id, track_id)"""
+    from queries.db_user_access import get_user_id_by_telegram_id
+    from queries.locations import start_track
+
+    trace = synthetic_trace(size, seed=seed)
+    async with session_factory() as session:
+        user_id = await get_user_id_by_telegram_id(session, TELEGRAM_ID_BASE + size)
+        track_id = await start_track(session, user_id, trace[0][2], live_period=86400)
+        for low in range(0, size, INSERT_CHUNK_SIZE):
+            chunk = trace[low:low + INSERT_CHUNK_SIZE]
+            await session.execute(INSERT_LOCATIONS, {
+                'track_id': track_id,
+                'lon': [fix[0] for fix in chunk],
+                'lat': [fix[1] for fix in chunk],
+                'ts': [fix[2] for fix in chunk],
+                'paused': [fix[3] for fix in chunk]
+            })
+            await session.commit()
+        await session.execute(text("ANALYZE locations"))
+        await session.commit()
+    return user_id, track_id
+
+
+async def delete_track(session_factory, track_id: int):
+    async with session_factory() as session:
+        await session.execute(text("DELETE FROM locations WHERE track_id = :track_id"), {'track_id': track_id})
+        await session.execute(text("DELETE FROM tracks WHERE track_id = :track_id"), {'track_id': track_id})
+        await session.commit()
+
+
+async def measure(session_factory, function, user_id: int, track_id: int, repeat: int) -> dict:
+    global query_count
+    wall_s = []
+    queries = 0
+    for _ in range(repeat):
+        query_count = 0
+        start = time.perf_counter()
+        async with session_factory() as session:
+            await function(session, track_id, user_id)
+        wall_s.append(time.perf_counter() - start)
+        queries = query_count
+
+    tracemalloc.start()
+    async with session_factory() as session:
+        await function(session, track_id, user_id)
+    peak_memory_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'wall_s_min': min(wall_s),
+        'wall_s_median': statistics.median(wall_s),
+        'queries': queries,
+        'peak_memory_bytes': peak_memory_bytes
+    }
+
+
+async def run(args) -> dict:
+    from database import engine, AsyncSessionLocal
+    from queries.locations import (calculate_speeds_for_track, get_segments_statistics, get_max_speed_for_track,
+                                   calculate_track_statistics)
+    # speeds first, the others read the speed_mps they store
+    functions = (calculate_speeds_for_track, get_segments_statistics, get_max_speed_for_track,
+                 calculate_track_statistics)
+
+    count_queries(engine)
+    async with AsyncSessionLocal() as session:
+        server_version = (await session.execute(text("SELECT version()"))).scalar()
+
+    results = []
+    for size in args.sizes:
+        user_id, track_id = await create_track(AsyncSessionLocal, size, args.seed)
+        try:
+            for function in functions:
+                result = {'function': function.__name__, 'points': size,
+                          **await measure(AsyncSessionLocal, function, user_id, track_id, args.repeat)}
+                results.append(result)
+                print(f"{result['function']:<30}{size:>10}{result['wall_s_median'] * 1000:>12.1f} ms"
+                      f"{result['queries']:>6} queries{result['peak_memory_bytes'] / 2 ** 20:>10.1f} MiB")
+        finally:
+            if not args.keep:
+                await delete_track(AsyncSessionLocal, track_id)
+
+    await engine.dispose()
+    return {
+        'meta': {
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'postgres': server_version,
+            'seed': args.seed,
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> bool:
+    """Print changes against the baseline, False when anything got slower or bigger than tolerance allows"""
+    previous = {(r['function'], r['points']): r for r in baseline['results']}
+    ok = True
+    for result in report['results']:
+        before = previous.get((result['function'], result['points']))
+        if before is None:
+            continue
+        time_ratio = result['wall_s_median'] / before['wall_s_median']
+        memory_ratio = result['peak_memory_bytes'] / max(before['peak_memory_bytes'], 1)
+        regressed = time_ratio > tolerance or memory_ratio > tolerance or result['queries'] > before['queries']
+        ok = ok and not regressed
+        print(f"{'REGRESSED' if regressed else 'ok':<10}{result['function']:<30}{result['points']:>10}"
+              f"  time x{time_ratio:.2f}  memory x{memory_ratio:.2f}"
+              f"  queries {before['queries']} -> {result['queries']}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                        default=list(DEFAULT_SIZES), help='comma separated track sizes in points')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark tracks in the database')
+    parser.add_argument('--migrate', action='store_true', help='run alembic upgrade head first')
+    parser.add_argument('--output', help='write the results as a JSON baseline to this file')
+    parser.add_argument('--compare', help='baseline JSON to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='allowed time and memory ratio to the baseline')
+    args = parser.parse_args()
+
+    output = args.output and os.path.abspath(args.output)
+    baseline_path = args.compare and os.path.abspath(args.compare)
+    use_app()
+    if args.migrate:
+        migrate()
+
+    report = asyncio.run(run(args))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.tolerance):
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
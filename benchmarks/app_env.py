@@ -0,0 +1,42 @@
+"""Import the app's modules from the benchmarks against the benchmark database.
+
+The app reads its settings from the environment and resolves templates and
+static files relative to its directory, so this has to run before the
+first app import.
+"""
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+
+# Matches docker-compose.yml next to this file
+BENCHMARK_ENV = {
+    'BOT_TOKEN': '123456:benchmark',
+    'BOT_USERNAME': 'benchmark_bot',
+    'BOT_ADMIN_ID': '0',
+    'DOMAIN_NAME': 'localhost',
+    'JWT_SECRET_KEY': 'benchmark-secret-key-of-at-least-32-bytes',
+    'COOKIE_NAME': 'aluwa_token',
+    'DB_DRIVER': 'postgresql+asyncpg',
+    'POSTGRES_USER': 'bench',
+    'POSTGRES_PASSWORD': 'bench',
+    'POSTGRES_DB': 'aluwa_bench',
+    'POSTGRES_HOST': 'localhost',
+    'POSTGRES_PORT': '55432',
+    'LOG_LEVEL': 'WARNING',
+}
+
+
+def use_app():
+    """Point the process at the app, values already in the environment win"""
+    for key, value in BENCHMARK_ENV.items():
+        os.environ.setdefault(key, value)
+    os.chdir(APP_DIR)
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+
+
+def migrate():
+    """Bring the benchmark database to the latest schema"""
+    subprocess.run([sys.executable, '-m', 'alembic', 'upgrade', 'head'], cwd=APP_DIR, env=os.environ, check=True)
@@ -0,0 +1,249 @@
+"""Replay bot traffic against the app and report latency per endpoint.
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    python benchmarks/loadtest.py --migrate --users 100 --points 300 --rate 2
+
+Every simulated user does what the bot does with a live location: gets a
+token from /auth/token, starts a track, posts its locations in batches
+(one by one with --batch-size 1) at --rate points per second, then stops
+the track. Without --base-url the app runs in this process through httpx's
+ASGI transport, with it the requests go to a running uvicorn, whose
+/metrics then provides the DB round trips.
+"""
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import json
+import math
+import os
+import re
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import httpx
+from sqlalchemy import event
+
+from app_env import use_app, migrate
+from traces import synthetic_trace
+
+# [count] of cursor executions of the request being sent, see count_round_trips
+round_trips = contextvars.ContextVar('round_trips', default=None)
+
+DB_QUERIES_METRIC = re.compile(r'^aluwa_db_query_duration_seconds_count\{[^}]*\} ([0-9.e+]+)$', re.MULTILINE)
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """Nearest rank percentile of already sorted values"""
+    if not sorted_values:
+        return math.nan
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.round_trips = defaultdict(int)
+        self.points = 0
+
+    async def call(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs):
+        counter = [0]
+        token = round_trips.set(counter)
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[endpoint] += 1
+            return None
+        finally:
+            self.latencies[endpoint].append(time.perf_counter() - start)
+            self.round_trips[endpoint] += counter[0]
+            round_trips.reset(token)
+        data = response.json() if response.status_code == 200 else None
+        # most endpoints report failures as 200 with error set
+        if data is None or isinstance(data, dict) and data.get('error') is True:
+            self.errors[endpoint] += 1
+            return None
+        return data
+
+    def report(self, elapsed_s: float, db_queries_total: float | None) -> dict:
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            endpoints[endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'throughput_rps': len(latencies) / elapsed_s,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                # only known in-process, a remote app's /metrics can't tell requests apart
+                'db_round_trips_per_request': self.round_trips[endpoint] / len(latencies)
+                if db_queries_total is None else None
+            }
+        requests = sum(len(latencies) for latencies in self.latencies.values())
+        if db_queries_total is None:
+            db_queries_total = sum(self.round_trips.values())
+        return {
+            'elapsed_s': elapsed_s,
+            'requests': requests,
+            'throughput_rps': requests / elapsed_s,
+            'points': self.points,
+            'points_per_s': self.points / elapsed_s,
+            'db_round_trips_per_request': db_queries_total / max(requests, 1),
+            'endpoints': endpoints
+        }
+
+
+def count_round_trips(engine):
+    """Count cursor executions into the counter of the request that caused them"""
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter = round_trips.get()
+        if counter is not None:
+            counter[0] += 1
+
+
+def token_query(telegram_id: int, bot_token: str) -> dict:
+    """Signed /auth/token query, as the bot's encode_query_data builds it"""
+    params = {'telegram_id': telegram_id}
+    data_check_string = '\n'.join(sorted(f'{x}={y}' for x, y in params.items()))
+    secret = hashlib.sha256(bot_token.encode()).digest()
+    return {**params, 'hash': hmac.new(secret, data_check_string.encode(), 'sha256').hexdigest()}
+
+
+async def simulate_user(client: httpx.AsyncClient, recorder: Recorder, args, index: int, bot_token: str):
+    await asyncio.sleep(args.ramp_s * index / max(args.users, 1))
+
+    result = await recorder.call(client, 'GET /auth/token', 'GET', '/auth/token',
+                                 params=token_query(args.telegram_id_base + index, bot_token))
+    if not result:
+        return
+    client_headers = {'Authorization': f"Bearer {result['token']}"}
+
+    start = datetime.now(timezone.utc)
+    result = await recorder.call(client, 'POST /track/start_track', 'POST', '/track/start_track',
+                                 headers=client_headers,
+                                 json={'start_timestamp': start.isoformat(), 'live_period': 86400})
+    if not result:
+        return
+    track_id = result['track_id']
+
+    interval_s = 1 / args.rate if args.rate > 0 else 1.0
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    batch = []
+    batch_started = started
+
+    async def flush():
+        if args.batch_size == 1:
+            await recorder.call(client, 'POST /track/location', 'POST', '/track/location',
+                                headers=client_headers, json=batch[0])
+        else:
+            await recorder.call(client, 'POST /track/locations/batch', 'POST', '/track/locations/batch',
+                                headers=client_headers, json=batch)
+        recorder.points += len(batch)
+        batch.clear()
+
+    trace = synthetic_trace(args.points, seed=args.seed * 1_000_003 + index, start=start, interval_s=interval_s)
+    for i, (lon, lat, timestamp, is_paused) in enumerate(trace):
+        if args.rate > 0:
+            await asyncio.sleep(max(0.0, started + i * interval_s - loop.time()))
+        if not batch:
+            batch_started = loop.time()
+        batch.append({
+            'track_id': track_id,
+            'latitude': lat,
+            'longitude': lon,
+            'device_timestamp': timestamp.isoformat(),
+            'is_paused': is_paused
+        })
+        if len(batch) >= args.batch_size or loop.time() - batch_started >= args.flush_interval_s:
+            await flush()
+    if batch:
+        await flush()
+
+    await recorder.call(client, 'POST /track/stop_track', 'POST', '/track/stop_track',
+                        headers=client_headers, json={'track_id': track_id})
+
+
+async def scrape_db_queries(client: httpx.AsyncClient) -> float:
+    response = await client.get('/metrics')
+    return sum(float(value) for value in DB_QUERIES_METRIC.findall(response.text))
+
+
+async def run(args) -> dict:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+
+    if args.base_url:
+        client = httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout_s)
+    else:
+        from main import app
+        from database import engine
+        count_round_trips(engine)
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://loadtest',
+                                   timeout=args.timeout_s)
+
+    async with client:
+        db_queries_before = await scrape_db_queries(client) if args.base_url else None
+        started = time.perf_counter()
+        await asyncio.gather(*(simulate_user(client, recorder, args, i, os.environ['BOT_TOKEN'])
+                               for i in range(args.users)))
+        elapsed_s = time.perf_counter() - started
+        db_queries_total = None
+        if args.base_url:
+            db_queries_total = await scrape_db_queries(client) - db_queries_before
+
+    return recorder.report(elapsed_s, db_queries_total)
+
+
+def print_report(report: dict):
+    print(f"{report['requests']} requests in {report['elapsed_s']:.1f}s, "
+          f"{report['throughput_rps']:.1f} req/s, {report['points_per_s']:.1f} points/s, "
+          f"{report['db_round_trips_per_request']:.2f} DB round trips per request")
+    print(f"{'endpoint':<30}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'db/req':>8}")
+    for endpoint, stats in report['endpoints'].items():
+        db = stats['db_round_trips_per_request']
+        print(f"{endpoint:<30}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput_rps']:>9.1f}"
+              f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+              f"{'-' if db is None else format(db, '.2f'):>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50, help='simulated bot users, each records one track')
+    parser.add_argument('--points', type=int, default=300, help='locations per track')
+    parser.add_argument('--rate', type=float, default=1.0, help='points per second per user, 0 sends at once')
+    parser.add_argument('--batch-size', type=int, default=50, help='locations per request, 1 uses /track/location')
+    parser.add_argument('--flush-interval-s', type=float, default=5.0, help='send a partial batch after this long')
+    parser.add_argument('--ramp-s', type=float, default=5.0, help='spread the user starts over this long')
+    parser.add_argument('--connections', type=int, default=100, help='HTTP connections against --base-url')
+    parser.add_argument('--timeout-s', type=float, default=30.0)
+    parser.add_argument('--base-url', help='a running app, e.g. http://localhost:8000, instead of in-process')
+    # users.telegram_id is a 32 bit integer
+    parser.add_argument('--telegram-id-base', type=int, default=1_900_000_000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--migrate', action='store_true', help='run alembic upgrade head first')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    output = args.output and os.path.abspath(args.output)
+    use_app()
+    if args.migrate:
+        migrate()
+
+    report = asyncio.run(run(args))
+    report['config'] = vars(args)
+    print_report(report)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
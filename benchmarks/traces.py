@@ -0,0 +1,76 @@
+"""Deterministic synthetic GPS traces for the benchmarks.
+
+A trace alternates between moving at walking to running speed, standing
+still and being paused by the user, with GPS jitter on every fix and a
+device clock that drifts, occasionally jumps and reports fixes out of
+order or twice. The same seed always gives the same trace.
+"""
+import math
+import random
+from datetime import datetime, timedelta, timezone
+
+METERS_PER_DEGREE = 111320.0
+
+MOVING = 'moving'
+STATIONARY = 'stationary'
+PAUSED = 'paused'
+
+
+def synthetic_trace(
+        count: int,
+        seed: int = 0,
+        start: datetime = datetime(2025, 1, 1, tzinfo=timezone.utc),
+        interval_s: float = 1.0,
+        jitter_m: float = 4.0,
+        skew_probability: float = 0.002,
+        skew_s: float = 5.0,
+        duplicate_probability: float = 0.001
+) -> list[tuple[float, float, datetime, bool]]:
+    """count (lon, lat, timestamp, is_paused) fixes.
+
+    skew_probability is the chance per fix of a clock glitch: the fix is
+    stamped up to skew_s seconds off, which puts it out of order.
+    duplicate_probability is the chance of a fix being sent again as is.
+    """
+    rng = random.Random(seed)
+    lat = 55.75 + rng.uniform(-0.1, 0.1)
+    lon = 37.62 + rng.uniform(-0.1, 0.1)
+    heading = rng.uniform(0, 2 * math.pi)
+    speed_mps = rng.uniform(1, 4)
+
+    state = MOVING
+    state_left = rng.randint(60, 900)
+    clock_offset_s = 0.0
+
+    trace = []
+    for i in range(count):
+        if trace and rng.random() < duplicate_probability:
+            trace.append(trace[-1])
+            continue
+        if state_left <= 0:
+            state = rng.choices((MOVING, STATIONARY, PAUSED), weights=(6, 2, 1))[0]
+            state_left = rng.randint(60, 900) if state == MOVING else rng.randint(30, 300)
+            speed_mps = rng.uniform(1, 4)
+        state_left -= 1
+
+        if state != STATIONARY:
+            heading += rng.gauss(0, 0.15)
+            speed_mps = min(6.0, max(0.5, speed_mps + rng.gauss(0, 0.1)))
+            step_m = speed_mps * interval_s
+            lat += step_m * math.cos(heading) / METERS_PER_DEGREE
+            lon += step_m * math.sin(heading) / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+
+        # slow drift of the device clock, and a rare jump when it resyncs
+        clock_offset_s += rng.gauss(0, 0.002)
+        if rng.random() < 0.0005:
+            clock_offset_s = rng.uniform(-2, 2)
+        skew = rng.uniform(-skew_s, skew_s) if rng.random() < skew_probability else 0.0
+        timestamp = start + timedelta(seconds=i * interval_s + clock_offset_s + skew)
+
+        trace.append((
+            lon + rng.gauss(0, jitter_m) / (METERS_PER_DEGREE * math.cos(math.radians(lat))),
+            lat + rng.gauss(0, jitter_m) / METERS_PER_DEGREE,
+            timestamp,
+            state == PAUSED
+        ))
+    return trace
@@ -1,17 +1,44 @@
 from joserfc import jwt
 from env_settings import env
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from collections import OrderedDict
 
 
 import logging
 import hashlib
 import hmac
+import time
 
 BOT_TOKEN_HASH = hashlib.sha256(env.BOT_TOKEN.encode())
 
+# user_id -> (token, exp), tokens are reused until shortly before they expire
+_token_cache: "OrderedDict[int, tuple[str, int]]" = OrderedDict()
+
 def encode_token(payload: Dict):
+    payload = {'exp': int(time.time()) + env.JWT_TTL_S, **payload}
     return jwt.encode({'alg': 'HS256'}, payload, env.JWT_SECRET_KEY)
 
+def remember_user_token(user_id: int, token: str, exp: Optional[int]):
+    """Keep an already issued token, e.g. the one returned by /auth/token"""
+    if exp is None:
+        return
+    _token_cache[user_id] = (token, exp)
+    _token_cache.move_to_end(user_id)
+    while len(_token_cache) > env.TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+
+def get_user_token(user_id: int) -> str:
+    """Return a cached token for the user, signing a new one only near expiry"""
+    cached = _token_cache.get(user_id)
+    if cached and cached[1] - env.JWT_REFRESH_MARGIN_S > time.time():
+        _token_cache.move_to_end(user_id)
+        return cached[0]
+
+    exp = int(time.time()) + env.JWT_TTL_S
+    token = encode_token({'user_id': user_id, 'exp': exp})
+    remember_user_token(user_id, token, exp)
+    return token
+
 def encode_query_data(params: dict) -> dict:
     """
     Encode query parameters for Telegram bot in the correct format.
@@ -7,6 +7,34 @@ class EnvSettings(BaseSettings):
     PROTOCOL: str
     JWT_SECRET_KEY: str
     COOKIE_NAME: str
+    JWT_TTL_S: int = 3600
+    JWT_REFRESH_MARGIN_S: int = 60
+    TOKEN_CACHE_SIZE: int = 10000
+    HTTP_POOL_SIZE: int = 100
+    HTTP_KEEPALIVE_S: float = 60
+    HTTP_TIMEOUT_S: float = 10
+    LOCATION_BATCH_SIZE: int = 50
+    LOCATION_FLUSH_INTERVAL_S: float = 5
+    LOCATION_FLUSH_RETRIES: int = 3
+    LOCATION_QUEUE_SIZE: int = 1000
+    METRICS_PORT: int = 9100
+    # 'polling' or 'webhook'
+    BOT_MODE: str = 'polling'
+    WEBHOOK_PATH: str = '/telegram/webhook'
+    WEBHOOK_HOST: str = '0.0.0.0'
+    WEBHOOK_PORT: int = 8080
+    # sent back by Telegram in X-Telegram-Bot-Api-Secret-Token, required in webhook mode
+    WEBHOOK_SECRET: str = ''
+    # False to run locally without registering the webhook with Telegram
+    WEBHOOK_REGISTER: bool = True
+    WEBHOOK_MAX_CONNECTIONS: int = 40
+    WEBHOOK_WORKERS: int = 64
+    WEBHOOK_QUEUE_SIZE: int = 100
+    WEBHOOK_DRAIN_TIMEOUT_S: float = 30
+    # worker processes, updates are routed to them by telegram id, 1 runs everything in one process
+    BOT_SHARDS: int = 1
+    SHARD_QUEUE_SIZE: int = 1000
+    SHARD_HEARTBEAT_S: float = 1
 
     class Config:
         env_file = ".env"
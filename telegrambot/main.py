@@ -1,5 +1,6 @@
 import time
 import asyncio
+import logging
 from datetime import datetime
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
@@ -9,14 +10,21 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.types import Message, ReplyKeyboardRemove, MenuButtonWebApp, WebAppInfo, FSInputFile
 
 from aiogram.filters import Command
-from requests import send_location, req_start_track, req_stop_track, get_token
-from auth import encode_token
+from requests import send_locations_batch, req_start_track, req_stop_track, get_token, open_http_session, close_http_session
+from auth import get_user_token, remember_user_token
+from webhook import run_webhook
+from sharding import run_sharded
 from joserfc import jwt
+from prometheus_client import start_http_server
+from metrics import ACTIVE_TRACKS, LOCATION_QUEUE_DEPTH, LOCATION_QUEUE_DEPTH_MAX, LOCATIONS_QUEUED, LOCATIONS_SENT, LOCATIONS_DROPPED
 
 from env_settings import env
 
-
-
+logging.basicConfig(
+    level=logging.DEBUG if env.DEBUG else logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
 
 
 
@@ -45,13 +53,17 @@ class Track:
         self.longitude = None
         self.latitude = None
         self.timestamp = start_timestamp
-        # self.task = None
-        # self.queue_payload = asyncio.Queue()
+        self.task = None
+        # bounded, update_location waits when the backend falls behind
+        self.queue_payload = asyncio.Queue(maxsize=env.LOCATION_QUEUE_SIZE)
 
     async def set_user_id(self):
         try:
             result = await get_token({'telegram_id': self.telegram_id})
-            self.user_id = jwt.decode(result["token"], env.JWT_SECRET_KEY).claims["user_id"]
+            claims = jwt.decode(result["token"], env.JWT_SECRET_KEY).claims
+            self.user_id = claims["user_id"]
+            # the token issued by the app is good for our own calls until it expires
+            remember_user_token(self.user_id, result["token"], claims.get("exp"))
         except Exception as e:
             print(e)
 
@@ -60,19 +72,47 @@ class Track:
             "start_timestamp": datetime.fromtimestamp(self.timestamp).isoformat(),
             "live_period": self.live_period
         }
-        result = await req_start_track(payload, encode_token({'user_id': self.user_id}))
-        self.track_id = result.get("track_id", -1)
-    '''
-    async def record_location(self):
-        """Start periodic recording"""
-        while self.is_active:
-            if self.track_id > 0 and not self.queue_payload.empty():
-                #print(payload)
-                while not self.queue_payload.empty():
-                    await send_location(self.queue_payload.get(), encode_token({'user_id': self.user_id}))
-                await asyncio.sleep(120)
-    '''
+        result = await req_start_track(payload, get_user_token(self.user_id))
+        self.track_id = (result or {}).get("track_id", -1)
 
+    def start_recording(self):
+        """Start the task that forwards buffered locations to the backend"""
+        self.task = asyncio.create_task(self.record_location())
+
+    async def record_location(self):
+        """Send buffered locations in batches, on size or time threshold"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            payload = await self.queue_payload.get()
+            if payload is None:
+                break
+            batch = [payload]
+            deadline = loop.time() + env.LOCATION_FLUSH_INTERVAL_S
+            while len(batch) < env.LOCATION_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    payload = await asyncio.wait_for(self.queue_payload.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if payload is None:
+                    stopping = True
+                    break
+                batch.append(payload)
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        """Send one batch, the batch endpoint ignores duplicates so retries are safe"""
+        for attempt in range(env.LOCATION_FLUSH_RETRIES):
+            if await send_locations_batch(batch, get_user_token(self.user_id)) is not None:
+                LOCATIONS_SENT.inc(len(batch))
+                return
+            await asyncio.sleep(2 ** attempt)
+        LOCATIONS_DROPPED.inc(len(batch))
+        logger.warning("Dropped %d locations of track %s after %d attempts",
+                       len(batch), self.track_id, env.LOCATION_FLUSH_RETRIES)
 
     async def update_location(self, location, timestamp):
         """Update the latest location data"""
@@ -86,23 +126,18 @@ class Track:
             "longitude": self.longitude,
             "is_paused": self.is_paused
         }
-        await send_location(payload, encode_token({'user_id': self.user_id}))
-        #self.queue_payload.put(payload)
+        await self.queue_payload.put(payload)
+        LOCATIONS_QUEUED.inc()
 
     async def stop_track(self):
         """Stop the recording track"""
         self.is_active = False
-        #while not self.queue_payload.empty():
-        #    await send_location(self.queue_payload.get(), encode_token({'user_id': self.user_id}))
-        result = await req_stop_track({"track_id": self.track_id}, encode_token({'user_id': self.user_id}))
-        '''
+        # final flush of buffered locations before the statistics are computed
         if self.task:
-            self.task.cancel()
-            try:
-                await self.task
-            except asyncio.CancelledError:
-                pass
-        '''
+            await self.queue_payload.put(None)
+            await self.task
+        result = await req_stop_track({"track_id": self.track_id}, get_user_token(self.user_id))
+
     def pause_track(self):
         self.is_paused = True
 
@@ -178,10 +213,10 @@ async def handle_live_location(message: Message):
     track = Track(telegram_id, update_timestamp, location)
     await track.set_user_id()
     await track.set_track_id()
-    await track.update_location(location, update_timestamp)
 
     # start task to send data to backend
-    #track.task = asyncio.create_task(track.record_location())
+    track.start_recording()
+    await track.update_location(location, update_timestamp)
     active_tracks[telegram_id] = track
 
     await message.answer(
@@ -210,7 +245,18 @@ async def handle_location_update(message: Message):
         track = active_tracks[user_id]
         await track.update_location(location, update_timestamp)
 
+ACTIVE_TRACKS.set_function(lambda: len(active_tracks))
+LOCATION_QUEUE_DEPTH.set_function(lambda: sum(t.queue_payload.qsize() for t in list(active_tracks.values())))
+LOCATION_QUEUE_DEPTH_MAX.set_function(
+    lambda: max((t.queue_payload.qsize() for t in list(active_tracks.values())), default=0))
+
+
 async def on_startup(dispatcher):
+    await open_http_session()
+    start_http_server(env.METRICS_PORT)
+    if env.BOT_MODE != "webhook":
+        # getUpdates is refused while a webhook from an earlier run is set
+        await bot.delete_webhook()
     if env.PROTOCOL == "https":
         await bot.set_chat_menu_button(
             menu_button=MenuButtonWebApp(
@@ -225,12 +271,19 @@ async def on_shutdown(dispatcher):
     # Stop all active tracks when bot shuts down
     for track in active_tracks.values():
         if track.is_active:
-            await track.stop()
+            await track.stop_track()
+    await close_http_session()
     print("Bot stopped")
 
 
+ALLOWED_UPDATES = ["message", "edited_message"]
+
 if __name__ == '__main__':
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
-    # For polling:
-    dp.run_polling(bot, allowed_updates=["message", "edited_message"])
\ No newline at end of file
+    if env.BOT_SHARDS > 1:
+        run_sharded(dp, bot, ALLOWED_UPDATES, active_tracks)
+    elif env.BOT_MODE == "webhook":
+        run_webhook(dp, bot, ALLOWED_UPDATES)
+    else:
+        dp.run_polling(bot, allowed_updates=ALLOWED_UPDATES)
\ No newline at end of file
@@ -0,0 +1,17 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+BACKEND_REQUEST_LATENCY = Histogram(
+    'aluwa_bot_backend_request_duration_seconds', 'Calls to the app backend, status is error when no response came',
+    ['method', 'path', 'status']
+)
+LOCATIONS_QUEUED = Counter('aluwa_bot_locations_queued_total', 'Locations put on track queues')
+LOCATIONS_SENT = Counter('aluwa_bot_locations_sent_total', 'Locations accepted by the backend')
+LOCATIONS_DROPPED = Counter('aluwa_bot_locations_dropped_total', 'Locations given up after all retries')
+ACTIVE_TRACKS = Gauge('aluwa_bot_active_tracks', 'Tracks being recorded')
+LOCATION_QUEUE_DEPTH = Gauge('aluwa_bot_location_queue_depth', 'Locations waiting on all track queues')
+LOCATION_QUEUE_DEPTH_MAX = Gauge('aluwa_bot_location_queue_depth_max', 'Locations waiting on the fullest track queue')
+UPDATE_QUEUE_DEPTH = Gauge('aluwa_bot_update_queue_depth', 'Webhook updates waiting for a worker')
+
+# filled by the process handling the updates, a shard when BOT_SHARDS > 1
+UPDATE_HANDLING_METRICS = (BACKEND_REQUEST_LATENCY, LOCATIONS_QUEUED, LOCATIONS_SENT, LOCATIONS_DROPPED, ACTIVE_TRACKS,
+                           LOCATION_QUEUE_DEPTH, LOCATION_QUEUE_DEPTH_MAX, UPDATE_QUEUE_DEPTH)
@@ -0,0 +1,41 @@
+"""POST recorded updates to a bot running in webhook mode.
+
+    BOT_MODE=webhook WEBHOOK_REGISTER=False WEBHOOK_SECRET=local python main.py
+    python replay_updates.py sample_updates.jsonl --secret local
+
+The file holds one update JSON per line, as Telegram sends them. Replies
+to the recorded chats fail unless the bot token can reach them, the
+backend calls are made either way.
+"""
+import argparse
+import asyncio
+import json
+
+import aiohttp
+
+# same as webhook.SECRET_TOKEN_HEADER, not imported so this runs without the bot's settings
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+async def replay(path: str, url: str, secret: str, delay_s: float):
+    with open(path) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    async with aiohttp.ClientSession() as session:
+        for update in updates:
+            async with session.post(url, json=update, headers={SECRET_TOKEN_HEADER: secret}) as response:
+                print(update["update_id"], response.status)
+            await asyncio.sleep(delay_s)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="file with one update JSON per line")
+    parser.add_argument("--url", default="http://localhost:8080/telegram/webhook")
+    parser.add_argument("--secret", required=True, help="the bot's WEBHOOK_SECRET")
+    parser.add_argument("--delay-s", type=float, default=0.0, help="pause between updates")
+    args = parser.parse_args()
+    asyncio.run(replay(args.path, args.url, args.secret, args.delay_s))
+
+
+if __name__ == "__main__":
+    main()
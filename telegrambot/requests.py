@@ -1,137 +1,117 @@
+import time
 import aiohttp
-from typing import Dict, Any
+import logging
+from typing import Dict, Any, List, Optional
 
 from urllib.parse import urlencode
 
 from auth import encode_query_data
 from env_settings import env
+from metrics import BACKEND_REQUEST_LATENCY
 
+logger = logging.getLogger(__name__)
 
-async def send_authenticated_post_request(payload: Dict, JWT_TOKEN: str):
-    """
-    Sends a POST request with JWT authorization.
-    Trigger with command: /post_example
-    """
-    headers = {
-        "Authorization": f"Bearer {JWT_TOKEN}",
-        "Content-Type": "application/json"
-    }
+BASE_URL = "{}://{}".format(env.PROTOCOL, env.DOMAIN_NAME)
 
+# One keep-alive session shared by every request, see open_http_session
+_session: Optional[aiohttp.ClientSession] = None
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    "{}://{}/message_from_bot".format(env.PROTOCOL, env.DOMAIN_NAME),
-                    json=payload,
-                    headers=headers
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    print('Response:', data)
-                else:
-                    error = await response.text()
-                    print(error)
 
-    except Exception as e:
-        print(f"⚠️ Request failed: {str(e)}")
+class BackendRequestError(Exception):
+    """Failed call to the app backend"""
 
-async def get_token(payload):
-    headers = {
-        "Content-Type": "application/json"
-    }
+    def __init__(self, method: str, path: str, status: Optional[int] = None, detail: str = ""):
+        self.method = method
+        self.path = path
+        self.status = status
+        self.detail = detail
+        super().__init__(f"{method} {path} failed (status={status}): {detail}")
 
-    encoded = encode_query_data(payload)
-    query_string = urlencode(encoded)
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "detail": self.detail
+        }
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                    "{}://{}/auth/token".format(env.PROTOCOL, env.DOMAIN_NAME),
-                    params=query_string,
-                    headers=headers
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    print('Response:', data)
-                    return data
-                else:
-                    error = await response.text()
-                    print(error)
 
-    except Exception as e:
-        print(f"⚠️ Request failed: {str(e)}")
+async def open_http_session():
+    """Create the shared client session, called from the bot's on_startup"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=env.HTTP_POOL_SIZE,
+            keepalive_timeout=env.HTTP_KEEPALIVE_S
+        )
+        _session = aiohttp.ClientSession(
+            base_url=BASE_URL,
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=env.HTTP_TIMEOUT_S)
+        )
+    return _session
+
+
+async def close_http_session():
+    """Close the shared client session, called from the bot's on_shutdown"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
 
-async def send_location(payload: Dict, JWT_TOKEN: str):
 
+async def _request(method: str, path: str, JWT_TOKEN: Optional[str] = None, **kwargs):
+    """Send a request through the shared session.
+
+    Returns:
+        Decoded JSON response, or None when the request failed
+    """
     headers = {
-        "Authorization": f"Bearer {JWT_TOKEN}",
         "Content-Type": "application/json"
     }
+    if JWT_TOKEN:
+        headers["Authorization"] = f"Bearer {JWT_TOKEN}"
 
+    session = await open_http_session()
+    start = time.perf_counter()
+    status = "error"
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    "{}://{}/track/location".format(env.PROTOCOL, env.DOMAIN_NAME),
-                    json=payload,
-                    headers=headers
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    print('Response:', data)
-                    return data
-                else:
-                    error = await response.text()
-                    print(error)
-
+        async with session.request(method, path, headers=headers, **kwargs) as response:
+            status = str(response.status)
+            if response.status == 200:
+                data = await response.json()
+                logger.debug("%s %s -> %s", method, path, data)
+                return data
+            error = BackendRequestError(method, path, response.status, await response.text())
     except Exception as e:
-        print(f"⚠️ Request failed: {str(e)}")
+        error = BackendRequestError(method, path, None, f"{type(e).__name__}: {e}")
+    finally:
+        BACKEND_REQUEST_LATENCY.labels(method, path, status).observe(time.perf_counter() - start)
 
-async def req_start_track(payload: Dict, JWT_TOKEN: str):
+    logger.warning(str(error), extra={"backend_error": error.as_dict()})
+    return None
 
-    headers = {
-        "Authorization": f"Bearer {JWT_TOKEN}",
-        "Content-Type": "application/json"
-    }
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    "{}://{}/track/start_track".format(env.PROTOCOL, env.DOMAIN_NAME),
-                    json=payload,
-                    headers=headers
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    print('Response:', data)
-                    return data
-                else:
-                    error = await response.text()
-                    print(error)
+async def send_authenticated_post_request(payload: Dict, JWT_TOKEN: str):
+    """
+    Sends a POST request with JWT authorization.
+    Trigger with command: /post_example
+    """
+    return await _request("POST", "/message_from_bot", JWT_TOKEN, json=payload)
 
-    except Exception as e:
-        print(f"⚠️ Request failed: {str(e)}")
+async def get_token(payload):
+    encoded = encode_query_data(payload)
+    query_string = urlencode(encoded)
+    return await _request("GET", "/auth/token", params=query_string)
 
-async def req_stop_track(payload: Dict, JWT_TOKEN: str):
+async def send_location(payload: Dict, JWT_TOKEN: str):
+    return await _request("POST", "/track/location", JWT_TOKEN, json=payload)
 
-    headers = {
-        "Authorization": f"Bearer {JWT_TOKEN}",
-        "Content-Type": "application/json"
-    }
+async def send_locations_batch(payloads: List[Dict], JWT_TOKEN: str):
+    return await _request("POST", "/track/locations/batch", JWT_TOKEN, json=payloads)
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    "{}://{}/track/stop_track".format(env.PROTOCOL, env.DOMAIN_NAME),
-                    headers=headers,
-                    json=payload
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    print('Response:', data)
-                    return data
-                else:
-                    error = await response.text()
-                    print(error)
+async def req_start_track(payload: Dict, JWT_TOKEN: str):
+    return await _request("POST", "/track/start_track", JWT_TOKEN, json=payload)
 
-    except Exception as e:
-        print(f"⚠️ Request failed: {str(e)}")
\ No newline at end of file
+async def req_stop_track(payload: Dict, JWT_TOKEN: str):
+    return await _request("POST", "/track/stop_track", JWT_TOKEN, json=payload)
@@ -0,0 +1,290 @@
+"""Run the bot as a front process and BOT_SHARDS worker processes.
+
+The front receives updates, by webhook or polling, and routes each one by
+its user's telegram id to a shard. A shard is a forked process with its
+own event loop, dispatcher and slice of active_tracks, handling the
+updates of its users through UpdateWorkers, so the updates of one user
+keep their order end to end. Shards report a heartbeat, their queue depth,
+active tracks and handled updates through shared memory, exported on the
+front's metrics port. Shard i serves its own metrics on METRICS_PORT + 1 + i.
+
+When a shard dies its users' tracks are gone, so the front shuts everything
+down and leaves the restart to the container.
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from prometheus_client import start_http_server, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+
+from env_settings import env
+from metrics import UPDATE_HANDLING_METRICS, UPDATE_QUEUE_DEPTH
+from webhook import UpdateWorkers, update_key, create_update_handler, register_webhook, check_webhook_settings
+
+logger = logging.getLogger(__name__)
+
+# per shard slots in the shared status array
+HEARTBEAT, QUEUE_DEPTH, ACTIVE_TRACKS, HANDLED = range(4)
+STATUS_FIELDS = 4
+
+
+def shard_for(key: int, shards: int) -> int:
+    return key % shards
+
+
+class ShardRouter:
+    """Forwards updates to the shard inboxes, one forwarding task per shard.
+
+    A single forwarder per shard keeps the order of submit calls, also
+    when the inbox is full and the put has to wait in a thread. Updates
+    for a dead shard are dropped right away instead of waiting on its
+    full inbox.
+    """
+
+    def __init__(self, inboxes: list, processes: list):
+        self.inboxes = inboxes
+        self.processes = processes
+        self.pending = [asyncio.Queue(maxsize=env.SHARD_QUEUE_SIZE) for _ in inboxes]
+        self.tasks = []
+        # loop time close() has to finish by, None until it is called
+        self.deadline = None
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.forward(pending, inbox, process))
+                      for pending, inbox, process in zip(self.pending, self.inboxes, self.processes)]
+
+    async def submit(self, data: dict):
+        await self.pending[shard_for(update_key(data), len(self.pending))].put(data)
+
+    async def put(self, inbox, process, data) -> bool:
+        """Put into a shard inbox, False when the shard died or stayed full for too long"""
+        try:
+            inbox.put_nowait(data)
+            return True
+        except queue.Full:
+            pass
+        loop = asyncio.get_running_loop()
+        give_up = loop.time() + env.WEBHOOK_DRAIN_TIMEOUT_S
+        # short waits in the thread, so a shard dying or the close deadline is noticed in time
+        while process.is_alive():
+            remaining = min(give_up, self.deadline or give_up) - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.to_thread(inbox.put, data, True, min(remaining, env.SHARD_HEARTBEAT_S))
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def forward(self, pending: asyncio.Queue, inbox, process):
+        dropped = 0
+        while True:
+            data = await pending.get()
+            if not await self.put(inbox, process, data) and data is not None:
+                dropped += 1
+                # a dead shard is reported by the monitor, a stuck one only here
+                if process.is_alive():
+                    logger.error("Dropped update %s, shard inbox full", data.get("update_id"))
+            if data is None:
+                if dropped:
+                    logger.error("Dropped %d updates for %s", dropped, process.name)
+                return
+
+    async def close(self, timeout: float):
+        """Forward what is pending, followed by the stop marker for every shard, within one timeout"""
+        loop = asyncio.get_running_loop()
+        self.deadline = loop.time() + timeout
+        for pending in self.pending:
+            try:
+                pending.put_nowait(None)
+            except asyncio.QueueFull:
+                try:
+                    await asyncio.wait_for(pending.put(None), max(0.0, self.deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    pass
+        done, not_done = await asyncio.wait(self.tasks, timeout=max(0.0, self.deadline - loop.time()))
+        for task in not_done:
+            task.cancel()
+        if not_done:
+            await asyncio.gather(*not_done, return_exceptions=True)
+            logger.warning("Gave up forwarding to %d shards after %ss", len(not_done), timeout)
+        for inbox, process in zip(self.inboxes, self.processes):
+            if not process.is_alive():
+                # nobody reads what is left, don't let exit wait to flush it
+                inbox.cancel_join_thread()
+
+    def queue_depth(self, index: int) -> int:
+        return self.pending[index].qsize() + self.inboxes[index].qsize()
+
+
+class ShardCollector:
+    """Shard health for Prometheus, read from the shared status at scrape time"""
+
+    def __init__(self, processes: list, status, router: ShardRouter):
+        self.processes = processes
+        self.status = status
+        self.router = router
+
+    def collect(self):
+        up = GaugeMetricFamily('aluwa_bot_shard_up', 'Shard process alive with a recent heartbeat',
+                               labels=['shard'])
+        heartbeat_age = GaugeMetricFamily('aluwa_bot_shard_heartbeat_age_seconds', 'Time since the last heartbeat',
+                                          labels=['shard'])
+        queue_depth = GaugeMetricFamily('aluwa_bot_shard_queue_depth', 'Updates routed to the shard, not handled yet',
+                                        labels=['shard'])
+        active_tracks = GaugeMetricFamily('aluwa_bot_shard_active_tracks', 'Tracks recorded by the shard',
+                                          labels=['shard'])
+        handled = CounterMetricFamily('aluwa_bot_shard_updates_handled', 'Updates handled by the shard',
+                                      labels=['shard'])
+        now = time.time()
+        for index, process in enumerate(self.processes):
+            slot = index * STATUS_FIELDS
+            label = [str(index)]
+            age = now - self.status[slot + HEARTBEAT]
+            up.add_metric(label, float(process.is_alive() and age < 3 * env.SHARD_HEARTBEAT_S))
+            heartbeat_age.add_metric(label, age)
+            queue_depth.add_metric(label, self.router.queue_depth(index) + self.status[slot + QUEUE_DEPTH])
+            active_tracks.add_metric(label, self.status[slot + ACTIVE_TRACKS])
+            handled.add_metric(label, self.status[slot + HANDLED])
+        return [up, heartbeat_age, queue_depth, active_tracks, handled]
+
+
+def run_shard(index: int, dispatcher: Dispatcher, bot: Bot, inbox, status, active_tracks: dict):
+    """Entry point of a shard process"""
+    # the front decides when to stop, it sends None through the inbox
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    env.METRICS_PORT = env.METRICS_PORT + 1 + index
+    asyncio.run(serve_shard(index, dispatcher, bot, inbox, status, active_tracks))
+
+
+async def serve_shard(index: int, dispatcher: Dispatcher, bot: Bot, inbox, status, active_tracks: dict):
+    loop = asyncio.get_running_loop()
+    workers = UpdateWorkers(dispatcher, bot, env.WEBHOOK_WORKERS, env.WEBHOOK_QUEUE_SIZE)
+    UPDATE_QUEUE_DEPTH.set_function(workers.queue_depth)
+    workers.start()
+    await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher)
+    slot = index * STATUS_FIELDS
+
+    async def heartbeat():
+        while True:
+            status[slot + QUEUE_DEPTH] = workers.queue_depth()
+            status[slot + ACTIVE_TRACKS] = len(active_tracks)
+            status[slot + HANDLED] = workers.handled
+            status[slot + HEARTBEAT] = time.time()
+            await asyncio.sleep(env.SHARD_HEARTBEAT_S)
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    # multiprocessing queues block, read them on a thread of their own
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        while True:
+            data = await loop.run_in_executor(reader, inbox.get)
+            if data is None:
+                break
+            await workers.submit(data)
+
+    await workers.drain(env.WEBHOOK_DRAIN_TIMEOUT_S)
+    heartbeat_task.cancel()
+    await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher)
+    await bot.session.close()
+
+
+async def poll_updates(bot: Bot, router: ShardRouter, allowed_updates: list[str]):
+    """Long polling in the front, updates are passed on as JSON and decoded again in their shard"""
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.warning("getUpdates failed: %s", e)
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await router.submit(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+
+
+async def monitor_shards(processes: list, stopping: asyncio.Event):
+    while not stopping.is_set():
+        dead = [process.name for process in processes if not process.is_alive()]
+        if dead:
+            logger.error("Shards %s died, shutting down", dead)
+            stopping.set()
+            return
+        await asyncio.sleep(env.SHARD_HEARTBEAT_S)
+
+
+async def serve_front(bot: Bot, processes: list, inboxes: list, status, allowed_updates: list[str]) -> int:
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    router = ShardRouter(inboxes, processes)
+    router.start()
+    # the front records no tracks and calls no backend, its copies would always read 0
+    for metric in UPDATE_HANDLING_METRICS:
+        REGISTRY.unregister(metric)
+    REGISTRY.register(ShardCollector(processes, status, router))
+    start_http_server(env.METRICS_PORT)
+
+    draining = False
+    runner = None
+    poller = None
+    if env.BOT_MODE == "webhook":
+        app = web.Application()
+        app.router.add_post(env.WEBHOOK_PATH, create_update_handler(router.submit, lambda: draining))
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, env.WEBHOOK_HOST, env.WEBHOOK_PORT).start()
+        await register_webhook(bot, allowed_updates)
+    else:
+        poller = asyncio.create_task(poll_updates(bot, router, allowed_updates))
+    monitor = asyncio.create_task(monitor_shards(processes, stopping))
+
+    await stopping.wait()
+    shard_died = monitor.done()
+    monitor.cancel()
+
+    # stop taking updates, hand over what was taken, then let every shard drain
+    draining = True
+    if poller:
+        poller.cancel()
+    if runner:
+        await runner.cleanup()
+    await router.close(env.WEBHOOK_DRAIN_TIMEOUT_S)
+    # the shards drain in parallel, one deadline for all of them
+    deadline = loop.time() + env.WEBHOOK_DRAIN_TIMEOUT_S
+    for process in processes:
+        await asyncio.to_thread(process.join, max(0.0, deadline - loop.time()))
+        if process.is_alive():
+            logger.warning("Shard %s didn't stop in time, terminating it", process.name)
+            process.terminate()
+    await bot.session.close()
+    return 1 if shard_died else 0
+
+
+def run_sharded(dispatcher: Dispatcher, bot: Bot, allowed_updates: list[str], active_tracks: dict):
+    if env.BOT_MODE == "webhook":
+        check_webhook_settings()
+    # forked before any event loop or thread exists, the shards inherit the dispatcher and its handlers
+    context = multiprocessing.get_context("fork")
+    inboxes = [context.Queue(maxsize=env.SHARD_QUEUE_SIZE) for _ in range(env.BOT_SHARDS)]
+    status = context.Array("d", env.BOT_SHARDS * STATUS_FIELDS, lock=False)
+    processes = [
+        context.Process(target=run_shard, name=f"shard-{index}",
+                        args=(index, dispatcher, bot, inboxes[index], status, active_tracks))
+        for index in range(env.BOT_SHARDS)
+    ]
+    for process in processes:
+        process.start()
+    raise SystemExit(asyncio.run(serve_front(bot, processes, inboxes, status, allowed_updates)))
@@ -0,0 +1,173 @@
+import asyncio
+import hmac
+import logging
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from env_settings import env
+from metrics import UPDATE_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def update_user_id(data: dict) -> Optional[int]:
+    """Telegram id of the user a raw update comes from, if any"""
+    for key, value in data.items():
+        if key != "update_id" and isinstance(value, dict):
+            user = value.get("from")
+            return user["id"] if user else None
+    return None
+
+
+def update_key(data: dict) -> int:
+    """Routing key keeping the updates of one user together"""
+    user_id = update_user_id(data)
+    return user_id if user_id is not None else data["update_id"]
+
+
+class UpdateWorkers:
+    """Fixed set of tasks feeding raw updates to the dispatcher.
+
+    Updates of one user always go to the same worker, so they are handled
+    in the order they arrived, while different users run concurrently on
+    up to `workers` tasks. Queues are bounded, submit waits when the
+    worker of a user falls behind.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int, queue_size: int):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.tasks = []
+        self.handled = 0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work(queue)) for queue in self.queues]
+
+    async def submit(self, data: dict):
+        await self.queues[update_key(data) % len(self.queues)].put(data)
+
+    async def work(self, queue: asyncio.Queue):
+        while True:
+            data = await queue.get()
+            if data is None:
+                # updates accepted while the stop was being queued
+                while not queue.empty():
+                    data = queue.get_nowait()
+                    if data is not None:
+                        await self.handle(data)
+                return
+            await self.handle(data)
+
+    async def handle(self, data: dict):
+        try:
+            update = Update.model_validate(data, context={"bot": self.bot})
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception:
+            logger.exception("Failed to handle update %s", data.get("update_id"))
+        self.handled += 1
+
+    async def drain(self, timeout: float):
+        """Handle what is queued, then stop the workers.
+
+        Queuing the stop markers counts against the timeout too, a worker
+        whose queue stays full is cancelled along with its queue.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        for queue in self.queues:
+            try:
+                queue.put_nowait(None)
+            except asyncio.QueueFull:
+                try:
+                    await asyncio.wait_for(queue.put(None), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    pass
+        done, pending = await asyncio.wait(self.tasks, timeout=max(0.0, deadline - loop.time()))
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning("Dropped the queues of %d workers still busy after %ss", len(pending), timeout)
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+
+def create_update_handler(submit: Callable[[dict], Awaitable[None]], is_draining: Callable[[], bool]):
+    """aiohttp handler checking the secret token and passing the update JSON to submit.
+
+    Requests without the secret token get 401. Updates arriving while
+    draining get 503, which makes Telegram send them again later.
+    """
+    async def handle_update(request: web.Request) -> web.Response:
+        secret = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(secret, env.WEBHOOK_SECRET):
+            return web.Response(status=401)
+        if is_draining():
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+            return web.Response(status=400)
+        await submit(data)
+        return web.Response()
+
+    return handle_update
+
+
+async def register_webhook(bot: Bot, allowed_updates: list[str]):
+    if env.WEBHOOK_REGISTER:
+        await bot.set_webhook(
+            url=f"{env.PROTOCOL}://{env.DOMAIN_NAME}{env.WEBHOOK_PATH}",
+            secret_token=env.WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+            max_connections=env.WEBHOOK_MAX_CONNECTIONS
+        )
+
+
+def check_webhook_settings():
+    if not env.WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set to run the bot in webhook mode")
+
+
+def create_webhook_app(dispatcher: Dispatcher, bot: Bot, allowed_updates: list[str]) -> web.Application:
+    """aiohttp app receiving updates on WEBHOOK_PATH.
+
+    On shutdown the listener is closed first, then queued updates are
+    handled before the dispatcher's shutdown handlers run.
+    """
+    app = web.Application()
+    workers = UpdateWorkers(dispatcher, bot, env.WEBHOOK_WORKERS, env.WEBHOOK_QUEUE_SIZE)
+    app["workers"] = workers
+    app["draining"] = False
+    UPDATE_QUEUE_DEPTH.set_function(workers.queue_depth)
+
+    async def on_startup(app: web.Application):
+        workers.start()
+        await dispatcher.emit_startup(bot=bot, dispatcher=dispatcher)
+        await register_webhook(bot, allowed_updates)
+
+    async def on_shutdown(app: web.Application):
+        app["draining"] = True
+        await workers.drain(env.WEBHOOK_DRAIN_TIMEOUT_S)
+        await dispatcher.emit_shutdown(bot=bot, dispatcher=dispatcher)
+        await bot.session.close()
+
+    app.router.add_post(env.WEBHOOK_PATH, create_update_handler(workers.submit, lambda: app["draining"]))
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+
+def run_webhook(dispatcher: Dispatcher, bot: Bot, allowed_updates: list[str]):
+    check_webhook_settings()
+    web.run_app(create_webhook_app(dispatcher, bot, allowed_updates), host=env.WEBHOOK_HOST, port=env.WEBHOOK_PORT,
+                shutdown_timeout=env.WEBHOOK_DRAIN_TIMEOUT_S)